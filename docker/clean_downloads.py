@@ -17,6 +17,10 @@ def clean_directory(directory):
     for file in os.listdir(directory):
         # get the full path of the file
         file_path = os.path.join(directory, file)
+        # keep the state kept beside the downloads, e.g. the download index
+        # and session info, which are hidden files in the download directory
+        if directory == download_dir and file.startswith('.'):
+            continue
         # check if the path is a file or a directory
         if os.path.isfile(file_path):
             # get the time the file was last modified
@@ -1,7 +1,7 @@
 import pytest
 import os
 import tempfile
-from wis2downloader.app import app
+from wis2downloader.app import create_app
 
 config = """
 {
@@ -34,12 +34,17 @@ def set_env():
         os.environ['WIS2DOWNLOADER_CONFIG'] = tp.name
 
 
+@pytest.fixture(scope='session')
+def app(set_env):
+    return create_app()
+
+
 @pytest.fixture()
-def client():
+def client(app):
     with app.test_client() as client:
         yield client
 
 
 @pytest.fixture()
-def runner():
+def runner(app):
     return app.test_cli_runner()
@@ -1,4 +1,6 @@
 import json
+import threading
+from urllib.parse import quote
 
 
 def test_expose_metrics(client):
@@ -28,12 +30,10 @@ def test_add_valid_subscription(client):
         "target": "test/target"
     }
     output = {
-        "pattern": "cache/a/wis2/ai-metservice/data/core/weather/surface-based-observations/synop",  # noqa
         "target": "test/target"
     }
     subscriptions = {
         "cache/a/wis2/ai-metservice/data/core/weather/surface-based-observations/synop": {  # noqa
-            "pattern": "cache/a/wis2/ai-metservice/data/core/weather/surface-based-observations/synop",  # noqa
             "target": "test/target"
         }
     }
@@ -112,3 +112,184 @@ def test_delete_invalid_topic(client):
     assert response.status_code == 400
     assert response.mimetype == 'text/html'
     assert expected_error in response.data
+
+
+def test_add_shared_subscription(client):
+    topic = "cache/a/wis2/ai-metservice/data/core/weather/surface-based-observations/synop"  # noqa
+    data = {
+        "topic": topic,
+        "target": "test/target",
+        "share_group": "downloaders"
+    }
+    output = {
+        "target": "test/target",
+        "share_group": "downloaders"
+    }
+
+    response = client.post('/subscriptions', json=data)
+    assert response.status_code == 201
+    assert json.loads(response.data) == output
+
+    response = client.delete(f'/subscriptions/{topic}')
+    assert response.status_code == 200
+    assert response.data == b'{}'
+
+
+def test_add_invalid_share_group(client):
+    data = {
+        "topic": "cache/a/wis2/ai-metservice/data/core/weather/surface-based-observations/synop",  # noqa
+        "target": "test/target",
+        "share_group": "a/b"
+    }
+
+    response = client.post('/subscriptions', json=data)
+
+    assert response.status_code == 400
+    assert b"share_group" in response.data
+
+
+def test_add_filtered_subscription(client):
+    topic = "cache/a/wis2/ai-metservice/data/core/weather/surface-based-observations/synop"  # noqa
+    data = {
+        "topic": topic,
+        "target": "test/target",
+        "filters": {"wigos_station_identifiers": ["0-20000-0-06631"]}
+    }
+
+    response = client.post('/subscriptions', json=data)
+    assert response.status_code == 201
+    assert json.loads(response.data)['filters'] == data['filters']
+
+    response = client.delete(f'/subscriptions/{topic}')
+    assert response.status_code == 200
+
+
+def test_add_invalid_filters(client):
+    data = {
+        "topic": "cache/a/wis2/ai-metservice/data/core/weather/surface-based-observations/synop",  # noqa
+        "target": "test/target",
+        "filters": {"bbox": [1, 2]}
+    }
+
+    response = client.post('/subscriptions', json=data)
+
+    assert response.status_code == 400
+    assert b"bbox" in response.data
+
+
+def test_add_subscriptions_batch(client):
+    topics = [
+        "cache/a/wis2/ai-metservice/data/core/weather/surface-based-observations/synop",  # noqa
+        "cache/a/wis2/ai-metservice/data/core/weather/surface-based-observations/temp"  # noqa
+    ]
+    data = {"subscriptions": [
+        {"topic": topics[0], "target": "test/target"},
+        {"topic": topics[1]}
+    ]}
+
+    response = client.post('/subscriptions:batch', json=data)
+    assert response.status_code == 201
+    response_data = json.loads(response.data)
+    assert set(response_data) == set(topics)
+    assert response_data[topics[1]]['target'] == "$TOPIC"
+
+    confirmation = json.loads(client.get('/subscriptions').data)
+    assert set(topics) <= set(confirmation)
+
+    for topic in topics:
+        response = client.delete(f'/subscriptions/{topic}')
+        assert response.status_code == 200
+
+
+def test_add_subscriptions_batch_invalid(client):
+    topic = "cache/a/wis2/ai-metservice/data/core/weather/surface-based-observations/synop"  # noqa
+    data = {"subscriptions": [
+        {"topic": topic, "target": "test/target"},
+        {"topic": topic, "filters": {"bbox": [1, 2]}}
+    ]}
+
+    response = client.post('/subscriptions:batch', json=data)
+    assert response.status_code == 400
+    assert b"bbox" in response.data
+
+    confirmation = json.loads(client.get('/subscriptions').data)
+    assert topic not in confirmation
+
+    response = client.post('/subscriptions:batch', json={"subscriptions": []})
+    assert response.status_code == 400
+
+
+def test_create_app_shares_runtime(app):
+    from wis2downloader.app import create_app
+
+    other = create_app()
+    assert other is not app
+    assert other.extensions['wis2downloader'] is \
+        app.extensions['wis2downloader']
+
+
+def test_startup_metrics(client):
+    response = client.get('/metrics')
+    assert b'startup_phase_seconds{phase="total"}' in response.data
+    assert b'startup_phase_seconds{phase="restore_subscriptions"}' in \
+        response.data
+
+
+class StubSubscriber:
+    """Stands in for the subscriber, recording subscriptions only"""
+    def __init__(self):
+        self.active_subscriptions = {}
+        self._lock = threading.Lock()
+
+    def add_subscription(self, topic, save_path=".", share_group=None,
+                         filters=None):
+        with self._lock:
+            self.active_subscriptions[topic] = {'target': save_path}
+            return dict(self.active_subscriptions)
+
+    def delete_subscription(self, topic):
+        with self._lock:
+            self.active_subscriptions.pop(topic, None)
+            return dict(self.active_subscriptions)
+
+
+def test_concurrent_subscription_requests(tmp_path):
+    from wis2downloader.app import create_app
+    from wis2downloader.runtime import Runtime
+
+    runtime = Runtime({'validate_topics': False})
+    runtime.subscriber = StubSubscriber()
+    runtime.mqtt_session = tmp_path / 'session.json'
+    runtime.session_info = {'topics': {}, 'client_id': 'client'}
+    app = create_app(runtime)
+    topics = [f"cache/a/wis2/centre-{idx}/data/core/weather/#"
+              for idx in range(40)]
+    barrier = threading.Barrier(8)
+    errors = []
+
+    def subscribe(idx):
+        client = app.test_client()
+        barrier.wait()
+        for topic in topics[idx::8]:
+            response = client.post('/subscriptions', json={
+                'topic': topic, 'target': 'target'})
+            if response.status_code != 201:
+                errors.append(response.data)
+        # Some subscriptions are removed while others are still added
+        response = client.delete(
+            f"/subscriptions/{quote(topics[idx], safe='')}")
+        if response.status_code != 200:
+            errors.append(response.data)
+
+    threads = [threading.Thread(target=subscribe, args=(idx,))
+               for idx in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    expected = {topic: 'target' for topic in topics[8:]}
+    assert runtime.session_info['topics'] == expected
+    assert json.loads(runtime.mqtt_session.read_text())['topics'] == expected
+    assert [path.name for path in tmp_path.iterdir()] == ['session.json']
@@ -0,0 +1,664 @@
+import base64
+import gzip
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+import time
+
+from prometheus_client import REGISTRY
+import pytest
+
+from wis2downloader.downloader import DownloadWorker, get_todays_date
+from wis2downloader.downloader.breaker import CircuitBreaker, CircuitState
+from wis2downloader.downloader.index import DownloadIndex
+from wis2downloader.downloader.inflight import InFlightRegistry
+from wis2downloader.downloader.retry import RetryPolicy
+from wis2downloader.downloader.sources import SourceStats
+from wis2downloader.downloader.watchdog import WorkerWatchdog
+from wis2downloader.job import Job
+from wis2downloader.queue import DelayQueue, PersistentQueue, SimpleQueue
+
+TOPIC = "cache/a/wis2/ai-metservice/data/core/weather/surface-based-observations/synop"  # noqa
+DATA = b"BUFR" + bytes(range(256)) * 64 + b"7777"
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if self.path.startswith('/slow'):
+            time.sleep(0.5)
+        if self.path.startswith('/missing'):
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.path.startswith('/busy'):
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(DATA)))
+        self.end_headers()
+        self.wfile.write(DATA)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+def make_job(url, data=DATA, data_id="ai-metservice/synop-001",
+             content=None):
+    digest = base64.b64encode(hashlib.sha256(data).digest()).decode()
+    properties = {
+        'data_id': data_id,
+        'integrity': {'method': 'sha256', 'value': digest}
+    }
+    if content is not None:
+        properties['content'] = content
+    return Job.from_notification(TOPIC, {
+        'properties': properties,
+        'links': [{
+            'rel': 'canonical',
+            'href': url,
+            'type': 'application/x-bufr',
+            'length': len(data)
+        }]
+    }, target='synop')
+
+
+def output_dir(basepath):
+    return basepath.joinpath(*get_todays_date(), 'synop')
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_download(server, tmp_path, stream):
+    worker = DownloadWorker(SimpleQueue(), tmp_path, 0, stream=stream,
+                            chunk_size=1024)
+    worker.process_job(make_job(f"{server}/obs.bufr4"))
+
+    target = output_dir(tmp_path) / 'obs.bufr'
+    assert target.read_bytes() == DATA
+    assert list(target.parent.iterdir()) == [target]
+    umask = os.umask(0)
+    os.umask(umask)
+    assert target.stat().st_mode & 0o777 == 0o666 & ~umask
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_download_string_length(server, tmp_path, stream):
+    # Publishers often give the length as a string, here without a hash
+    job = Job.from_notification(TOPIC, {
+        'properties': {'data_id': "ai-metservice/synop-002"},
+        'links': [{
+            'rel': 'canonical',
+            'href': f"{server}/string-length-{stream}/obs.bufr4",
+            'type': 'application/x-bufr',
+            'length': str(len(DATA))
+        }]
+    }, target='synop')
+    assert job.links[0][3] == len(DATA)
+
+    worker = DownloadWorker(SimpleQueue(), tmp_path, 0, stream=stream,
+                            chunk_size=1024)
+    worker.process_job(job)
+    assert (output_dir(tmp_path) / 'obs.bufr').read_bytes() == DATA
+
+
+@pytest.mark.parametrize('length', ['large', -1, [1000], True])
+def test_invalid_length_ignored(length):
+    job = Job.from_notification(TOPIC, {
+        'properties': {'data_id': "ai-metservice/synop-002"},
+        'links': [{'rel': 'canonical', 'href': "https://example.org/a",
+                   'length': length}]
+    })
+    assert job.links[0][3] is None
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_download_abandoned_when_oversized(server, tmp_path, stream):
+    worker = DownloadWorker(SimpleQueue(), tmp_path, 0, stream=stream,
+                            chunk_size=1024)
+    job = make_job(f"{server}/obs.bufr4")
+    job.links = [(rel, href, media_type, 2048)
+                 for rel, href, media_type, _ in job.links]
+    task = worker.prepare_task(job)
+
+    assert worker.fetch(task) is None
+    assert task.retryable
+    assert list(output_dir(tmp_path).iterdir()) == []
+
+
+def test_stream_discards_failed_verification(server, tmp_path):
+    worker = DownloadWorker(SimpleQueue(), tmp_path, 0, stream=True,
+                            chunk_size=1024)
+    worker.process_job(make_job(f"{server}/obs.bufr4", data=b"corrupt"))
+
+    assert list(output_dir(tmp_path).iterdir()) == []
+
+
+def test_stream_http_error(server, tmp_path):
+    worker = DownloadWorker(SimpleQueue(), tmp_path, 0, stream=True)
+    worker.process_job(make_job(f"{server}/missing.bufr4"))
+
+    assert list(output_dir(tmp_path).iterdir()) == []
+
+
+def test_index_persists(tmp_path):
+    path = str(tmp_path / 'index.db')
+    index = DownloadIndex(path, retention=3600)
+    index.add('synop-001:abc')
+    index.add('synop-002:def')
+    index.close()
+
+    index = DownloadIndex(path, retention=3600)
+    assert index.contains('synop-001:abc')
+    assert index.contains('synop-002:def')
+    assert not index.contains('synop-001:xyz')
+    index.close()
+
+
+def test_index_expires(tmp_path):
+    index = DownloadIndex(str(tmp_path / 'index.db'), retention=-1)
+    index.add('synop-001:abc')
+    assert not index.contains('synop-001:abc')
+
+
+def test_index_skips_duplicate(server, tmp_path):
+    index = DownloadIndex(str(tmp_path / 'index.db'))
+    worker = DownloadWorker(SimpleQueue(), tmp_path / 'data', 0, index=index)
+    job = make_job(f"{server}/obs.bufr4")
+    worker.process_job(job)
+
+    # Remove the file, as the cleaner would, and redeliver the notification
+    target = output_dir(tmp_path / 'data') / 'obs.bufr'
+    target.unlink()
+    worker.process_job(job)
+
+    assert not target.exists()
+
+
+def test_index_per_target(server, tmp_path):
+    index = DownloadIndex()
+    worker = DownloadWorker(SimpleQueue(), tmp_path, 0, index=index)
+    worker.process_job(make_job(f"{server}/obs.bufr4"))
+    # The same data for another subscription's target
+    job = make_job(f"{server}/obs.bufr4")
+    job.target = 'other'
+    worker.process_job(job)
+
+    assert (output_dir(tmp_path) / 'obs.bufr').read_bytes() == DATA
+    assert (tmp_path.joinpath(*get_todays_date(), 'other', 'obs.bufr')
+            .read_bytes() == DATA)
+
+
+def test_existing_file_indexed(server, tmp_path):
+    # As after a restart with an in-memory index
+    target = output_dir(tmp_path) / 'obs.bufr'
+    target.parent.mkdir(parents=True)
+    target.write_bytes(DATA)
+    index = DownloadIndex()
+    worker = DownloadWorker(SimpleQueue(), tmp_path, 0, index=index)
+    job = make_job(f"{server}/existing/obs.bufr4")
+
+    assert worker.prepare_task(job) is None
+    assert index.contains(DownloadIndex.make_key(
+        job.data_id, job.hash_value, job.target))
+    assert "/existing/obs.bufr4" not in FileHandler.requests
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_failed_write_not_indexed(server, tmp_path, stream):
+    index = DownloadIndex()
+    worker = DownloadWorker(SimpleQueue(), tmp_path, 0, index=index,
+                            stream=stream)
+    job = make_job(f"{server}/obs.bufr4")
+    task = worker.prepare_task(job)
+    # A directory in place of the file makes the write fail
+    task.target.mkdir()
+
+    assert worker.fetch(task) is None
+    assert not index.contains(task.index_key)
+
+
+def test_coalesce_concurrent_downloads(server, tmp_path):
+    index = DownloadIndex()
+    in_flight = InFlightRegistry()
+    workers = [
+        DownloadWorker(SimpleQueue(), tmp_path, 0, index=index,
+                       in_flight=in_flight)
+        for idx in range(3)
+    ]
+    # The same data announced by three different caches
+    threads = [
+        threading.Thread(target=worker.process_job,
+                         args=(make_job(f"{server}/slow/cache-{idx}/obs.bufr4"),))  # noqa
+        for idx, worker in enumerate(workers)
+    ]
+    FileHandler.requests.clear()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(FileHandler.requests) == 1
+    assert in_flight.size() == 0
+    assert (output_dir(tmp_path) / 'obs.bufr').read_bytes() == DATA
+
+
+def test_coalesce_timeout_downloads(server, tmp_path):
+    index = DownloadIndex()
+    in_flight = InFlightRegistry()
+    worker = DownloadWorker(SimpleQueue(), tmp_path, 0, index=index,
+                            in_flight=in_flight, coalesce_timeout=0.1)
+    job = make_job(f"{server}/obs.bufr4")
+    # A stalled download of the same data by another worker
+    task = worker.prepare_task(job)
+    flight, leader = in_flight.claim(task.index_key)
+    assert leader
+
+    worker.process_job(job)
+    assert (output_dir(tmp_path) / 'obs.bufr').read_bytes() == DATA
+    in_flight.release(task.index_key, flight, False)
+
+
+def test_coalesce_per_target(server, tmp_path):
+    index = DownloadIndex()
+    in_flight = InFlightRegistry()
+    workers = [
+        DownloadWorker(SimpleQueue(), tmp_path, 0, index=index,
+                       in_flight=in_flight)
+        for idx in range(2)
+    ]
+    jobs = [make_job(f"{server}/slow/cache-{idx}/obs.bufr4")
+            for idx in range(2)]
+    jobs[1].target = 'other'
+    threads = [
+        threading.Thread(target=worker.process_job, args=(job,))
+        for worker, job in zip(workers, jobs)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for target in ['synop', 'other']:
+        path = tmp_path.joinpath(*get_todays_date(), target, 'obs.bufr')
+        assert path.read_bytes() == DATA
+
+
+def test_source_ranking():
+    stats = SourceStats(alpha=0.5)
+    stats.record_success('https://slow.example/a.bufr4', 2.0, 1000, 1.0)
+    stats.record_success('https://fast.example/a.bufr4', 0.1, 1000, 0.1)
+    stats.record_failure('https://dead.example/a.bufr4')
+    stats.record_failure('https://dead.example/a.bufr4')
+
+    urls = ['https://dead.example/b.bufr4', 'https://slow.example/b.bufr4',
+            'https://fast.example/b.bufr4', 'https://new.example/b.bufr4']
+    assert stats.rank(urls) == [
+        'https://new.example/b.bufr4', 'https://fast.example/b.bufr4',
+        'https://slow.example/b.bufr4', 'https://dead.example/b.bufr4']
+
+
+def test_download_falls_back_to_alternate_link(server, tmp_path):
+    stats = SourceStats()
+    worker = DownloadWorker(SimpleQueue(), tmp_path, 0, source_stats=stats)
+    job = make_job(f"{server}/missing/obs.bufr4")
+    rel, _, media_type, length = job.links[0]
+    job.links += ((rel, f"{server}/obs.bufr4", media_type, length),)
+    worker.process_job(job)
+
+    assert (output_dir(tmp_path) / 'obs.bufr').read_bytes() == DATA
+    assert not stats.is_healthy(f"{server}/missing/obs.bufr4")
+
+
+def test_circuit_breaker():
+    url = 'https://cache.example/obs.bufr4'
+    breaker = CircuitBreaker(min_requests=2, reset_timeout=0.2)
+    breaker.record_failure(url)
+    assert breaker.allow(url)
+    breaker.record_failure(url)
+    assert breaker.state(url) == CircuitState.open
+    assert not breaker.allow(url)
+
+    time.sleep(0.25)
+    # Only a single probe is let through when half open
+    assert breaker.allow(url)
+    assert not breaker.allow(url)
+    breaker.record_success(url)
+    assert breaker.state(url) == CircuitState.closed
+
+
+def test_circuit_breaker_open_not_extended():
+    url = 'https://cache.example/obs.bufr4'
+    breaker = CircuitBreaker(min_requests=1, reset_timeout=0.2)
+    breaker.record_failure(url)
+    assert breaker.state(url) == CircuitState.open
+
+    # Late failures of downloads started before the circuit opened
+    time.sleep(0.15)
+    breaker.record_failure(url)
+    time.sleep(0.1)
+    assert breaker.state(url) == CircuitState.half_open
+
+
+def test_circuit_breaker_probe_timeout():
+    url = 'https://cache.example/obs.bufr4'
+    breaker = CircuitBreaker(min_requests=1, reset_timeout=0,
+                             probe_timeout=0.1)
+    breaker.record_failure(url)
+    assert breaker.allow(url)
+    assert not breaker.allow(url)
+
+    # The probe's outcome was never recorded
+    time.sleep(0.15)
+    assert breaker.allow(url)
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_verification_failure_not_held_against_host(server, tmp_path,
+                                                    stream):
+    breaker = CircuitBreaker(min_requests=1)
+    worker = DownloadWorker(SimpleQueue(), tmp_path, 0, breaker=breaker,
+                            stream=stream)
+    worker.process_job(make_job(f"{server}/obs.bufr4", data=b"corrupt"))
+
+    assert breaker.state(f"{server}/obs.bufr4") == CircuitState.closed
+
+
+def test_job_deferred_when_circuit_open(server, tmp_path):
+    breaker = CircuitBreaker(min_requests=1, reset_timeout=60)
+    breaker.record_failure(f"{server}/obs.bufr4")
+    queue = SimpleQueue()
+    delay_queue = DelayQueue(queue)
+    worker = DownloadWorker(queue, tmp_path, 0, breaker=breaker,
+                            delay_queue=delay_queue)
+
+    FileHandler.requests.clear()
+    worker.process_job(make_job(f"{server}/obs.bufr4"))
+
+    assert FileHandler.requests == []
+    assert delay_queue.size() == 1
+
+
+def test_deferral_abandoned_when_circuit_stays_open(server, tmp_path):
+    def count(name):
+        return REGISTRY.get_sample_value(f"{name}_total", {
+            'topic': TOPIC, 'centre_id': 'ai-metservice'}) or 0
+
+    url = f"{server}/dead/obs.bufr4"
+    # A host that never recovers
+    breaker = CircuitBreaker(min_requests=1, reset_timeout=3600)
+    breaker.record_failure(url)
+    queue = SimpleQueue()
+    delay_queue = DelayQueue(queue)
+    policy = RetryPolicy(max_attempts=3)
+    worker = DownloadWorker(queue, tmp_path, 0, breaker=breaker,
+                            delay_queue=delay_queue, retry_policy=policy)
+    failed = count('failed_downloads')
+    abandoned = count('download_retries_abandoned')
+
+    job = make_job(url)
+    assert worker.process_job(job)
+    assert worker.process_job(job)
+    assert job.attempt == 2
+    # Out of attempts, the job is not deferred again
+    assert not worker.process_job(job)
+    assert delay_queue.size() == 2
+    assert count('failed_downloads') == failed + 1
+    assert count('download_retries_abandoned') == abandoned + 1
+
+
+def test_retry_with_backoff(server, tmp_path):
+    queue = SimpleQueue()
+    delay_queue = DelayQueue(queue)
+    policy = RetryPolicy(max_attempts=2, base_delay=0.1)
+    worker = DownloadWorker(queue, tmp_path, 0, delay_queue=delay_queue,
+                            retry_policy=policy)
+    job = make_job(f"{server}/busy/obs.bufr4")
+
+    worker.process_job(job)
+    assert job.attempt == 1
+    assert delay_queue.size() == 1
+    assert delay_queue.pop_due(timeout=1.0) == [job]
+
+    # Second and final attempt, the job is abandoned
+    worker.process_job(job)
+    assert delay_queue.size() == 0
+
+
+def test_retry_survives_restart(server, tmp_path):
+    path = str(tmp_path / 'queue.db')
+    queue = PersistentQueue(path)
+    delay_queue = DelayQueue(queue)
+    worker = DownloadWorker(queue, tmp_path, 0, delay_queue=delay_queue,
+                            retry_policy=RetryPolicy(base_delay=60))
+    queue.enqueue(make_job(f"{server}/busy/obs.bufr4"))
+    job = queue.dequeue_many(1)[0]
+
+    # The job waits on the delay queue unacknowledged
+    assert worker.process_job(job)
+    queue.close()
+
+    queue = PersistentQueue(path)
+    assert queue.size() == 1
+    assert queue.dequeue().attempt == 0
+    queue.close()
+
+
+def test_retry_acknowledged_once_requeued(server, tmp_path):
+    path = str(tmp_path / 'queue.db')
+    queue = PersistentQueue(path)
+    delay_queue = DelayQueue(queue)
+    worker = DownloadWorker(queue, tmp_path, 0, delay_queue=delay_queue,
+                            retry_policy=RetryPolicy(base_delay=0.1))
+    queue.enqueue(make_job(f"{server}/busy/obs.bufr4"))
+    assert worker.process_job(queue.dequeue())
+
+    assert delay_queue.release_due(timeout=1.0) == 1
+    queue.close()
+
+    queue = PersistentQueue(path)
+    assert queue.size() == 1
+    assert queue.dequeue().attempt == 1
+    queue.close()
+
+
+def test_no_retry_for_missing_file(server, tmp_path):
+    queue = SimpleQueue()
+    delay_queue = DelayQueue(queue)
+    worker = DownloadWorker(queue, tmp_path, 0, delay_queue=delay_queue,
+                            retry_policy=RetryPolicy())
+    worker.process_job(make_job(f"{server}/missing/obs.bufr4"))
+
+    assert delay_queue.size() == 0
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_async_download(server, tmp_path, stream):
+    pytest.importorskip('aiohttp')
+    from wis2downloader.downloader.aio import AsyncDownloadWorker
+
+    queue = SimpleQueue()
+    worker = AsyncDownloadWorker(queue, concurrency=4, basepath=tmp_path,
+                                 min_free_space=0, stream=stream,
+                                 chunk_size=1024)
+    for idx in range(8):
+        queue.enqueue(make_job(f"{server}/obs-{idx}.bufr4"))
+    queue.enqueue(Job(shutdown=True))
+    worker.start()
+
+    files = sorted(p.name for p in output_dir(tmp_path).iterdir())
+    assert files == [f"obs-{idx}.bufr" for idx in range(8)]
+    assert worker.status == "ready"
+
+
+def test_async_worker_process_job(server, tmp_path):
+    pytest.importorskip('aiohttp')
+    from wis2downloader.downloader.aio import AsyncDownloadWorker
+
+    worker = AsyncDownloadWorker(SimpleQueue(), basepath=tmp_path,
+                                 min_free_space=0, stream=True)
+    # The same synchronous interface as the threaded worker
+    assert worker.process_job(make_job(f"{server}/obs.bufr4")) is False
+    assert (output_dir(tmp_path) / 'obs.bufr').read_bytes() == DATA
+
+    task = worker.prepare_task(make_job(f"{server}/missing/other.bufr4"))
+    assert worker.fetch(task) is None
+
+
+def test_workers_take_one_job_at_a_time(server, tmp_path):
+    queue = SimpleQueue()
+    workers = [DownloadWorker(queue, tmp_path, 0) for idx in range(2)]
+    for idx in range(2):
+        queue.enqueue(make_job(f"{server}/slow/obs-{idx}.bufr4",
+                               data_id=f"synop-{idx}"))
+    for idx in range(2):
+        queue.enqueue(Job(shutdown=True))
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=worker.start) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Downloaded side by side rather than one after the other by a worker
+    # holding both jobs
+    assert time.monotonic() - start < 0.9
+    assert len(list(output_dir(tmp_path).iterdir())) == 2
+
+
+def test_download_deadline(server, tmp_path):
+    queue = SimpleQueue()
+    delay_queue = DelayQueue(queue)
+    worker = DownloadWorker(queue, tmp_path, 0, delay_queue=delay_queue,
+                            retry_policy=RetryPolicy(), deadline=0.2)
+    worker.process_job(make_job(f"{server}/slow/obs.bufr4"))
+
+    assert list(output_dir(tmp_path).iterdir()) == []
+    # Timeouts are worth retrying
+    assert delay_queue.size() == 1
+
+
+def test_watchdog_replaces_stuck_worker(tmp_path):
+    queue = SimpleQueue()
+    workers = [DownloadWorker(queue, tmp_path, 0)]
+    threads = [threading.Thread(target=lambda: None)]
+    watchdog = WorkerWatchdog(workers, threads,
+                              lambda: DownloadWorker(queue, tmp_path, 0),
+                              timeout=0.1)
+    stuck = workers[0]
+    stuck.set_status("running")
+    assert watchdog.check() == 0
+
+    time.sleep(0.15)
+    assert watchdog.check() == 1
+    assert stuck.abandoned
+    assert workers[0] is not stuck
+
+    # Stop the replacement worker
+    queue.enqueue(Job(shutdown=True))
+    threads[0].join(timeout=1)
+    assert not threads[0].is_alive()
+
+
+def test_watchdog_releases_stuck_download(server, tmp_path):
+    def failed():
+        return REGISTRY.get_sample_value('failed_downloads_total', {
+            'topic': TOPIC, 'centre_id': 'ai-metservice'}) or 0
+
+    queue = SimpleQueue()
+    in_flight = InFlightRegistry()
+    worker = DownloadWorker(queue, tmp_path, 0, in_flight=in_flight)
+    workers = [worker]
+    threads = [threading.Thread(target=worker.process_job,
+                                args=(make_job(f"{server}/slow/obs.bufr4"),))]
+    watchdog = WorkerWatchdog(workers, threads,
+                              lambda: DownloadWorker(queue, tmp_path, 0),
+                              timeout=0)
+    stuck = threads[0]
+    stuck.start()
+    time.sleep(0.2)
+    assert in_flight.size() == 1
+    before = failed()
+    worker.set_status("running")
+
+    assert watchdog.check() == 1
+    # Jobs for the same data no longer wait on the stuck download
+    assert in_flight.size() == 0
+    assert failed() == before + 1
+
+    queue.enqueue(Job(shutdown=True))
+    threads[0].join(timeout=1)
+    stuck.join(timeout=1)
+
+
+@pytest.mark.parametrize('encoding', ['base64', 'gzip'])
+def test_inline_content(server, tmp_path, encoding):
+    value = DATA if encoding == 'base64' else gzip.compress(DATA)
+    content = {
+        'encoding': encoding,
+        'value': base64.b64encode(value).decode(),
+        'size': len(DATA)
+    }
+    job = make_job(f"{server}/missing/obs.bufr4", content=content)
+    worker = DownloadWorker(SimpleQueue(), basepath=tmp_path,
+                            min_free_space=0)
+    FileHandler.requests.clear()
+    worker.process_job(job)
+    assert (output_dir(tmp_path) / 'obs.bufr').read_bytes() == DATA
+    assert FileHandler.requests == []
+
+
+def test_truncated_inline_content_downloaded(server, tmp_path):
+    content = {
+        'encoding': 'base64',
+        'value': base64.b64encode(DATA[:100]).decode(),
+        'size': len(DATA)
+    }
+    job = make_job(f"{server}/inline/obs.bufr4", content=content)
+    worker = DownloadWorker(SimpleQueue(), basepath=tmp_path,
+                            min_free_space=0)
+    worker.process_job(job)
+    assert (output_dir(tmp_path) / 'obs.bufr').read_bytes() == DATA
+    assert '/inline/obs.bufr4' in FileHandler.requests
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_latency_metrics(server, tmp_path, stream):
+    def count(name, **labels):
+        return REGISTRY.get_sample_value(f"{name}_count", labels) or 0
+
+    names = ['queue_wait_seconds', 'download_ttfb_seconds',
+             'download_transfer_seconds', 'download_verify_seconds',
+             'download_write_seconds']
+    before = {name: count(name) for name in names}
+    latency_before = count('notification_to_disk_seconds',
+                           centre_id='ai-metservice')
+
+    job = make_job(f"{server}/latency-{stream}/obs.bufr4")
+    job.pubtime = "2024-01-01T00:00:00Z"
+    job.queued_at = time.time()
+    worker = DownloadWorker(SimpleQueue(), tmp_path, 0, stream=stream)
+    worker.process_job(job)
+
+    assert (output_dir(tmp_path) / 'obs.bufr').read_bytes() == DATA
+    for name in names:
+        assert count(name) == before[name] + 1, name
+    assert count('notification_to_disk_seconds',
+                 centre_id='ai-metservice') == latency_before + 1
+    assert REGISTRY.get_sample_value(
+        'notification_to_disk_seconds_bucket',
+        {'centre_id': 'ai-metservice', 'le': '21600.0'}) == 0
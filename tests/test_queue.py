@@ -0,0 +1,192 @@
+import threading
+import time
+
+from prometheus_client import REGISTRY
+import pytest
+
+from wis2downloader.job import Job
+from wis2downloader.queue import (OverflowFile, PersistentQueue, RedisQueue,
+                                  SimpleQueue)
+
+
+def redis_client():
+    fakeredis = pytest.importorskip('fakeredis')
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture(params=['simple', 'persistent', 'redis'])
+def queue(request, tmp_path):
+    if request.param == 'simple':
+        yield SimpleQueue()
+    elif request.param == 'persistent':
+        q = PersistentQueue(str(tmp_path / 'queue.db'))
+        yield q
+        q.close()
+    else:
+        yield RedisQueue(client=redis_client(), consumer='node-1', block=0.1,
+                         stats_interval=0)
+
+
+def test_fifo(queue):
+    for idx in range(5):
+        queue.enqueue(Job(data_id=idx))
+    assert queue.size() == 5
+    items = []
+    for _ in range(5):
+        item = queue.dequeue()
+        items.append(item.data_id)
+        queue.task_done(item)
+    assert items == list(range(5))
+    assert queue.is_empty()
+
+
+def test_batches(queue):
+    queue.enqueue_many([Job(data_id=idx) for idx in range(5)])
+    assert queue.size() == 5
+    items = queue.dequeue_many(3, timeout=1)
+    assert [item.data_id for item in items] == [0, 1, 2]
+    for item in items:
+        queue.task_done(item)
+    items = queue.dequeue_many(3, timeout=1)
+    assert [item.data_id for item in items] == [3, 4]
+    assert queue.dequeue_many(3, timeout=0.1) == []
+
+
+def test_dequeue_blocks_until_enqueue(queue):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(queue.dequeue()))
+    thread.start()
+    queue.enqueue(Job(data_id=1))
+    thread.join(timeout=5)
+    assert result == [Job(data_id=1)]
+
+
+def test_persistent_queue_recovers_unacknowledged(tmp_path):
+    path = str(tmp_path / 'queue.db')
+    q = PersistentQueue(path)
+    for idx in range(3):
+        q.enqueue(Job(data_id=idx))
+    done = q.dequeue()
+    q.task_done(done)
+    q.dequeue()  # in progress when the process stops
+    q.close()
+
+    q = PersistentQueue(path)
+    assert q.size() == 2
+    assert [q.dequeue().data_id, q.dequeue().data_id] == [1, 2]
+    q.close()
+
+
+def test_persistent_queue_keeps_control_items_in_memory(tmp_path):
+    path = str(tmp_path / 'queue.db')
+    q = PersistentQueue(path)
+    q.enqueue(Job(shutdown=True))
+    assert q.dequeue() == Job(shutdown=True)
+    q.enqueue(Job(shutdown=True))
+    q.close()
+
+    q = PersistentQueue(path)
+    assert q.is_empty()
+    q.close()
+
+
+def test_redis_queue_shared_between_consumers():
+    client = redis_client()
+    producer = RedisQueue(client=client, consumer='node-1', block=0.1)
+    consumer = RedisQueue(client=client, consumer='node-2', block=0.1)
+    producer.enqueue(Job(data_id=1))
+    item = consumer.dequeue()
+    assert item == Job(data_id=1)
+    assert producer.size() == 0
+    consumer.task_done(item)
+    assert client.xlen(producer.stream) == 0
+
+
+def test_redis_queue_reclaims_from_dead_consumer():
+    client = redis_client()
+    dead = RedisQueue(client=client, consumer='node-1', block=0.1,
+                      visibility_timeout=0.1)
+    dead.enqueue(Job(data_id=1))
+    dead.dequeue()  # never acknowledged
+    time.sleep(0.2)
+
+    alive = RedisQueue(client=client, consumer='node-2', block=0.1,
+                       visibility_timeout=0.1)
+    item = alive.dequeue()
+    assert item == Job(data_id=1)
+    alive.task_done(item)
+    assert client.xlen(alive.stream) == 0
+
+
+def test_redis_queue_skips_deleted_reclaimed_entries():
+    client = redis_client()
+    dead = RedisQueue(client=client, consumer='node-1', block=0.1,
+                      visibility_timeout=0.1)
+    dead.enqueue_many([Job(data_id=1), Job(data_id=2)])
+    dead.dequeue_many(2)  # never acknowledged
+    time.sleep(0.2)
+
+    alive = RedisQueue(client=client, consumer='node-2', block=0.1,
+                       visibility_timeout=0.1)
+    xautoclaim = client.xautoclaim
+
+    def deleted_first(*args, **kwargs):
+        # As Redis 6.2 returns entries deleted since they were delivered
+        result = xautoclaim(*args, **kwargs)
+        result[1] = [(b'0-1', None)] + result[1]
+        return result
+
+    client.xautoclaim = deleted_first
+    items = alive.dequeue_many(3)
+    assert items == [Job(data_id=1), Job(data_id=2)]
+
+
+def test_redis_queue_size_cached():
+    client = redis_client()
+    queue = RedisQueue(client=client, consumer='node-1', block=0.1,
+                       stats_interval=60)
+    assert queue.size() == 0
+    queue.enqueue(Job(data_id=1))
+    # Read from Redis at most once every stats_interval seconds
+    assert queue.size() == 0
+    queue.stats_interval = 0
+    assert queue.size() == 1
+    assert REGISTRY.get_sample_value(
+        'queue_size_lag', {'group': queue.group}) == 1
+
+
+def test_bounded_queue_spills_to_disk(tmp_path):
+    q = SimpleQueue(max_size=4, low_watermark=2,
+                    overflow_path=str(tmp_path / 'overflow.jsonl'))
+    for idx in range(10):
+        q.enqueue(Job(data_id=idx))
+    assert q.size() == 10
+    assert q.is_saturated()
+    assert len(q._items) == 4
+
+    items = []
+    for idx in range(10):
+        items.append(q.dequeue().data_id)
+        assert len(q._items) <= 4
+        if idx == 3:
+            # new items join the back of the queue while spilling
+            q.enqueue(Job(data_id=10))
+    items.append(q.dequeue().data_id)
+    assert items == list(range(11))
+    assert q.is_empty()
+    assert not q.is_saturated()
+
+
+def test_overflow_file_compacted(tmp_path):
+    path = tmp_path / 'overflow.jsonl'
+    overflow = OverflowFile(str(path), compact_size=1)
+    for idx in range(10):
+        overflow.write(Job(data_id=idx))
+
+    # Half the items read, they are dropped from the file
+    assert overflow.read(5) == [Job(data_id=idx) for idx in range(5)]
+    assert path.read_bytes().count(b'\n') == 5
+    overflow.write(Job(data_id=10))
+    assert overflow.read(10) == [Job(data_id=idx) for idx in range(5, 11)]
+    assert overflow.size() == 0
+    overflow.close()
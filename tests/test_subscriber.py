@@ -0,0 +1,383 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from wis2downloader.job import Job
+from wis2downloader.queue import SimpleQueue
+import wis2downloader.subscriber
+from wis2downloader.subscriber import MQTTSubscriber
+from wis2downloader.subscriber.dedup import SeenMessages, message_key
+from wis2downloader.subscriber.filters import ContentFilter
+from wis2downloader.subscriber.manager import SubscriberManager
+from wis2downloader.subscriber.topics import TopicMatcher
+
+
+@pytest.mark.parametrize('topic_filter,topic,matches', [
+    ('a/b/c', 'a/b/c', True),
+    ('a/b/c', 'a/b', False),
+    ('a/+/c', 'a/b/c', True),
+    ('a/+/c', 'a/b/x/c', False),
+    ('a/+', 'a/', True),
+    ('a/#', 'a', True),
+    ('a/#', 'a/b/c/d', True),
+    ('a/#', 'ab/c', False),
+    ('+/b', 'a/b', True),
+    ('#', 'a/b', True),
+    ('#', '$SYS/broker', False),
+    ('+/broker', '$SYS/broker', False),
+    ('cache/a/wis2/+/data/core/weather/#',
+     'cache/a/wis2/de-dwd/data/core/weather/surface-based-observations/synop',  # noqa
+     True),
+    ('cache/a/wis2/+/data/core/weather/#',
+     'cache/a/wis2/de-dwd/data/core/climate/surface-based-observations',
+     False),
+])
+def test_topic_matching(topic_filter, topic, matches):
+    matcher = TopicMatcher({topic_filter: 'target'})
+    assert (matcher.match(topic) == 'target') is matches
+
+
+def test_topic_matching_preference():
+    matcher = TopicMatcher({
+        'a/#': 'first',
+        'a/+/c': 'second',
+        'a/b/c': 'exact'
+    })
+    assert matcher.match('a/b/c') == 'exact'
+    assert matcher.match('a/x/c') == 'first'
+    assert matcher.match('b') is None
+
+
+def test_seen_messages_window():
+    seen = SeenMessages(max_size=10, window=0.1)
+    assert seen.add('a')
+    assert not seen.add('a')
+    time.sleep(0.15)
+    assert seen.add('a')
+
+
+def test_seen_messages_bounded():
+    seen = SeenMessages(max_size=10, window=3600)
+    for idx in range(100):
+        assert seen.add(idx)
+    assert seen.size() == 10
+    assert not seen.add(99)
+    assert seen.add(0)
+
+
+def test_message_key():
+    assert message_key({'id': 'abc'}) == 'abc'
+    assert message_key({'properties': {
+        'data_id': 'x', 'pubtime': '2024-01-01T00:00:00Z'}}) == \
+        'x@2024-01-01T00:00:00Z'
+    assert message_key({}) is None
+
+
+NOTIFICATION = {
+    'geometry': {'type': 'Point', 'coordinates': [7.45, 46.95]},
+    'properties': {
+        'data_id': 'ch-meteoswiss/data/core/weather/synop/WIGOS_0-20000-0-06631',  # noqa
+        'wigos_station_identifier': '0-20000-0-06631'
+    },
+    'links': [{
+        'rel': 'canonical',
+        'href': 'https://example.org/data.bufr4',
+        'type': 'application/bufr',
+        'length': 1000
+    }]
+}
+
+
+@pytest.mark.parametrize('filters,accepted', [
+    ({}, True),
+    ({'media_types': ['application/bufr']}, True),
+    ({'media_types': ['application/grib']}, False),
+    ({'max_length': 1000}, True),
+    ({'max_length': 999}, False),
+    ({'data_id': 'synop/WIGOS_0-20000-0-066'}, True),
+    ({'data_id': '^synop'}, False),
+    ({'wigos_station_identifiers': ['0-20000-0-06631']}, True),
+    ({'wigos_station_identifiers': ['0-20000-0-06610']}, False),
+    ({'bbox': [5.9, 45.8, 10.5, 47.8]}, True),
+    ({'bbox': [-10, 35, 0, 45]}, False),
+    ({'bbox': [170, -50, 10, 50]}, True),
+    ({'media_types': ['application/bufr'], 'max_length': 10}, False),
+])
+def test_content_filter(filters, accepted):
+    assert ContentFilter(filters).accepts(NOTIFICATION) is accepted
+
+
+@pytest.mark.parametrize('length,accepted', [
+    ('1000', True),
+    ('1001', False),
+    (1000.0, True),
+    ('large', False),
+    ([1000], False),
+    (None, True),
+])
+def test_content_filter_length(length, accepted):
+    link = dict(NOTIFICATION['links'][0], length=length)
+    notification = dict(NOTIFICATION, links=[link])
+    content_filter = ContentFilter({'max_length': 1000})
+    assert content_filter.accepts(notification) is accepted
+
+
+@pytest.mark.parametrize('filters', [
+    {'unknown': 1},
+    {'max_length': -1},
+    {'data_id': '('},
+    {'bbox': [1, 2, 3]},
+    {'media_types': 'application/bufr'},
+])
+def test_invalid_content_filter(filters):
+    with pytest.raises(ValueError):
+        ContentFilter(filters)
+
+
+class StubSubscriber:
+    """Stands in for MQTTSubscriber, recording subscriptions only"""
+    def __init__(self, broker, port, username, password, protocol,
+                 _queue, client_id, **kwargs):
+        self.broker = broker
+        self.client_id = client_id
+        self.kwargs = kwargs
+        self.active_subscriptions = {}
+        self.batches = []
+
+    def add_subscription(self, topic, save_path=".", share_group=None,
+                         filters=None):
+        self.active_subscriptions[topic] = {'target': save_path}
+        return self.active_subscriptions
+
+    def add_subscriptions(self, subscriptions):
+        self.batches.append([item['topic'] for item in subscriptions])
+        for item in subscriptions:
+            self.active_subscriptions[item['topic']] = {
+                'target': item.get('target', ".")}
+        return self.active_subscriptions
+
+    def delete_subscription(self, topic):
+        self.active_subscriptions.pop(topic, None)
+        return self.active_subscriptions
+
+    def stop(self):
+        pass
+
+
+class StubManager(SubscriberManager):
+    subscriber_class = StubSubscriber
+
+
+def make_broker(hostname):
+    return {'hostname': hostname, 'port': 1883, 'username': None,
+            'password': None, 'protocol': 'tcp'}
+
+
+def test_subscriber_manager_shards_and_deduplicates():
+    brokers = [make_broker('a.example.org'), make_broker('b.example.org')]
+    manager = StubManager(brokers, 3, SimpleQueue(), client_id='client')
+    assert [[subscriber.broker for subscriber in subscribers]
+            for subscribers in manager.subscribers] == \
+        [['a.example.org'] * 3, ['b.example.org'] * 3]
+    # One client id per connection, for persistent sessions
+    client_ids = [subscriber.client_id for subscribers in manager.subscribers
+                  for subscriber in subscribers]
+    assert len(set(client_ids)) == 6
+    # All connections share one record of the notifications seen, on by
+    # default with several connections
+    assert manager.seen is not None
+    assert manager.seen.window == 3600
+    for subscribers in manager.subscribers:
+        for subscriber in subscribers:
+            assert subscriber.kwargs['dedup'] is manager.seen
+
+    topics = [f"cache/a/wis2/centre-{idx}/data/core/weather/#"
+              for idx in range(10)]
+    for topic in topics:
+        manager.add_subscription(topic, "target")
+    assert set(manager.list_subscriptions()) == set(topics)
+
+    for topic in topics:
+        for subscribers in manager.subscribers:
+            holding = [idx for idx, subscriber in enumerate(subscribers)
+                       if topic in subscriber.active_subscriptions]
+            assert holding == [manager.shard(topic)]
+
+    manager.delete_subscription(topics[0])
+    assert topics[0] not in manager.list_subscriptions()
+    for subscribers in manager.subscribers:
+        for subscriber in subscribers:
+            assert topics[0] not in subscriber.active_subscriptions
+
+    batch = [f"cache/a/wis2/centre-{idx}/data/core/climate/#"
+             for idx in range(10)]
+    manager.add_subscriptions([{'topic': topic, 'target': "target"}
+                               for topic in batch])
+    assert set(batch) <= set(manager.list_subscriptions())
+    for topic in batch:
+        for subscribers in manager.subscribers:
+            holding = [idx for idx, subscriber in enumerate(subscribers)
+                       if topic in subscriber.active_subscriptions]
+            assert holding == [manager.shard(topic)]
+    # One SUBSCRIBE per connection
+    for subscribers in manager.subscribers:
+        for subscriber in subscribers:
+            assert len(subscriber.batches) <= 1
+
+    with pytest.raises(ValueError):
+        manager.add_subscriptions([
+            {'topic': "cache/a/wis2/x/data/core/hydrology/#"},
+            {'topic': "cache/a/wis2/y/data/core/hydrology/#",
+             'filters': {'bbox': [1, 2]}}])
+    assert "cache/a/wis2/x/data/core/hydrology/#" not in \
+        manager.list_subscriptions()
+    manager.stop()
+
+
+def test_subscriber_manager_without_deduplication():
+    manager = StubManager([make_broker('a.example.org')], _queue=SimpleQueue())
+    assert manager.seen is None
+    assert manager.subscribers[0][0].kwargs['dedup'] is None
+
+
+def test_subscriber_manager_requires_broker():
+    with pytest.raises(ValueError):
+        StubManager([], _queue=SimpleQueue())
+
+
+TOPIC = "cache/a/wis2/ch-meteoswiss/data/core/weather/surface-based-observations/synop"  # noqa
+
+
+def make_subscriber(_queue, **kwargs):
+    # Connecting is left to start(), so no broker is needed
+    subscriber = MQTTSubscriber('127.0.0.1', 1883, protocol='tcp',
+                                _queue=_queue, **kwargs)
+    subscriber.add_subscription("cache/a/wis2/+/data/core/weather/#",
+                                "synop")
+    return subscriber
+
+
+def make_message(idx=0):
+    notification = dict(NOTIFICATION, id=f"message-{idx}")
+    return SimpleNamespace(topic=TOPIC,
+                           payload=json.dumps(notification).encode())
+
+
+def test_network_loop_not_paused(tmp_path):
+    _queue = SimpleQueue(max_size=1,
+                         overflow_path=str(tmp_path / 'overflow.jsonl'))
+    subscriber = make_subscriber(_queue, decoder_threads=1,
+                                 decoder_queue_size=1, backpressure_delay=1)
+    _queue.enqueue_many([Job(data_id=0), Job(data_id=1)])
+    assert _queue.is_saturated()
+
+    start = time.monotonic()
+    # Handed to the decoder threads, then queued directly once they are
+    # full, without pausing
+    subscriber._on_message(subscriber.client, None, make_message(2))
+    subscriber._on_message(subscriber.client, None, make_message(3))
+    assert time.monotonic() - start < 0.5
+    assert subscriber._messages.qsize() == 1
+    assert _queue.size() == 3
+
+
+@pytest.mark.parametrize('decoder', ['json', 'orjson'])
+def test_decoder_threads_queue_jobs(monkeypatch, decoder):
+    if decoder == 'orjson':
+        orjson = pytest.importorskip('orjson')
+        monkeypatch.setattr(wis2downloader.subscriber, 'json_loads',
+                            orjson.loads)
+    else:
+        monkeypatch.setattr(wis2downloader.subscriber, 'json_loads',
+                            json.loads)
+
+    _queue = SimpleQueue()
+    subscriber = make_subscriber(_queue, decoder_threads=1)
+    thread = threading.Thread(target=subscriber.run_decoder, daemon=True)
+    thread.start()
+
+    # The network loop only hands the message over
+    subscriber._on_message(subscriber.client, None, make_message(0))
+    jobs = _queue.dequeue_many(10, timeout=5)
+
+    assert len(jobs) == 1
+    job = jobs[0]
+    assert job.topic == TOPIC
+    assert job.target == 'synop'
+    assert job.queued_at is not None
+    assert job.data_id == NOTIFICATION['properties']['data_id']
+    assert job.links == (('canonical', 'https://example.org/data.bufr4',
+                          'application/bufr', 1000),)
+    assert job.payload is None
+    assert subscriber._messages.empty()
+
+
+class FailingQueue(SimpleQueue):
+    def __init__(self):
+        super().__init__()
+        self.fail = True
+
+    def enqueue(self, item):
+        if self.fail:
+            raise RuntimeError("queue unavailable")
+        super().enqueue(item)
+
+
+def test_duplicates_recorded_once_queued():
+    _queue = FailingQueue()
+    subscriber = make_subscriber(_queue, dedup=SeenMessages())
+
+    # Not queued, so the redelivered message is not a duplicate
+    with pytest.raises(RuntimeError):
+        subscriber._on_message(subscriber.client, None, make_message(0))
+    assert subscriber.dedup.size() == 0
+
+    _queue.fail = False
+    before = time.time()
+    subscriber._on_message(subscriber.client, None, make_message(0))
+    subscriber._on_message(subscriber.client, None, make_message(0))
+    assert _queue.size() == 1
+    # Latencies are measured from the enqueue
+    assert _queue.dequeue().queued_at >= before
+    assert subscriber.dedup.size() == 1
+
+
+def test_duplicates_claimed_atomically():
+    # The same messages received on two connections at once
+    _queue = SimpleQueue()
+    seen = SeenMessages()
+    subscribers = [make_subscriber(_queue, dedup=seen) for _ in range(2)]
+    barrier = threading.Barrier(2)
+
+    def receive(subscriber):
+        barrier.wait()
+        for idx in range(200):
+            subscriber._on_message(subscriber.client, None,
+                                   make_message(idx))
+
+    threads = [threading.Thread(target=receive, args=(subscriber,))
+               for subscriber in subscribers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert _queue.size() == 200
+    assert seen.size() == 200
+
+
+def test_decoder_threads_skip_duplicates():
+    _queue = SimpleQueue()
+    subscriber = make_subscriber(_queue, decoder_threads=1,
+                                 dedup=SeenMessages())
+    for idx in [0, 0, 1]:
+        subscriber._on_message(subscriber.client, None, make_message(idx))
+    thread = threading.Thread(target=subscriber.run_decoder, daemon=True)
+    thread.start()
+
+    jobs = _queue.dequeue_many(10, timeout=5)
+    assert len(jobs) == 2
+    assert subscriber.dedup.size() == 2
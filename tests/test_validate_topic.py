@@ -0,0 +1,125 @@
+import shutil
+
+import pytest
+import pywis_topics.topics
+
+import wis2downloader.utils.validate_topic
+from wis2downloader.utils.validate_topic import TopicValidator
+
+LEVELS = {
+    'channel': ['cache', 'origin'],
+    'version': ['a'],
+    'system': ['wis2'],
+    'centre-id': ['ai-metservice'],
+    'notification-type': ['data', 'metadata'],
+    'data-policy': ['core', 'recommended'],
+    'earth-system-discipline': [
+        'weather/surface-based-observations/synop',
+        'weather/surface-based-observations/temp'
+    ]
+}
+
+
+def write_tables(path):
+    tables = path / 'wis2-topic-hierarchy'
+    tables.mkdir()
+    for level, values in LEVELS.items():
+        (tables / f'{level}.csv').write_text(
+            'Name,Description\n' + ''.join(f'{v},\n' for v in values))
+
+
+@pytest.fixture
+def validator(tmp_path):
+    write_tables(tmp_path)
+    return TopicValidator(tables=str(tmp_path))
+
+
+@pytest.fixture
+def bundle(tmp_path, monkeypatch):
+    """The default bundle directory, empty, with syncing failing part way
+    through as when the connection drops. Returns the directory and the
+    number of syncs attempted"""
+    userdir = tmp_path / 'pywis-topics'
+    syncs = []
+
+    def sync_bundle():
+        syncs.append(1)
+        shutil.rmtree(userdir, ignore_errors=True)
+        userdir.mkdir()
+        raise OSError("connection lost")
+
+    monkeypatch.setattr(wis2downloader.utils.validate_topic, 'USERDIR',
+                        userdir)
+    monkeypatch.setattr(wis2downloader.utils.validate_topic, 'sync_bundle',
+                        sync_bundle)
+    monkeypatch.setattr(pywis_topics.topics, 'WIS2_TOPIC_HIERARCHY_LOOKUP',
+                        userdir / 'wis2-topic-hierarchy')
+    return userdir, syncs
+
+
+@pytest.mark.parametrize('topic,valid', [
+    ('cache/a/wis2/ai-metservice/data/core/weather/surface-based-observations/synop', True),  # noqa
+    ('cache/a/wis2/+/data/core/weather/surface-based-observations/#', True),
+    ('invalid/topic/example', False),
+    ('cache/a/wis2/+/data/core/weather/unknown', False),
+])
+def test_validate(validator, topic, valid):
+    assert validator.is_valid(topic) is valid
+
+
+def test_results_cached(validator):
+    topic = 'cache/a/wis2/+/data/core/weather/surface-based-observations/#'
+    assert validator.is_valid(topic)
+    assert validator.is_valid(topic)
+    info = validator._validate.cache_info()
+    assert (info.hits, info.misses) == (1, 1)
+
+
+def test_failed_refresh_keeps_hierarchy(bundle):
+    userdir, syncs = bundle
+    userdir.mkdir()
+    write_tables(userdir)
+    validator = TopicValidator()
+    topic = 'cache/a/wis2/+/data/core/weather/surface-based-observations/#'
+    assert validator.is_valid(topic)
+
+    assert not validator.refresh()
+    assert len(syncs) == 1
+    assert validator.is_valid(topic)
+    # The bundle damaged by the failed sync was restored
+    assert (userdir / 'wis2-topic-hierarchy' / 'channel.csv').is_file()
+    assert TopicValidator().is_valid(topic)
+
+
+def test_failed_sync_not_retried(bundle):
+    _, syncs = bundle
+    validator = TopicValidator(retry_interval=3600)
+    topic = 'cache/a/wis2/+/data/core/weather/surface-based-observations/#'
+
+    # No local bundle and the sync fails
+    with pytest.raises(OSError):
+        validator.is_valid(topic)
+    assert len(syncs) == 1
+    with pytest.raises(OSError):
+        validator.is_valid(topic)
+    assert len(syncs) == 1
+
+    validator.retry_interval = 0
+    with pytest.raises(OSError):
+        validator.is_valid(topic)
+    assert len(syncs) == 2
+
+
+def test_failed_load_not_retried(tmp_path):
+    topic = 'cache/a/wis2/+/data/core/weather/surface-based-observations/#'
+    validator = TopicValidator(tables=str(tmp_path), retry_interval=3600)
+    with pytest.raises(OSError):
+        validator.is_valid(topic)
+
+    # The failure is kept until the retry interval has passed
+    write_tables(tmp_path)
+    with pytest.raises(OSError):
+        validator.is_valid(topic)
+
+    validator.retry_interval = 0
+    assert validator.is_valid(topic)
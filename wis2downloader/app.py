@@ -1,135 +1,29 @@
 import json
 from pathlib import Path
-import threading
 from urllib.parse import unquote
-from uuid import uuid4
 import yaml
 
-from flask import Flask, request, jsonify, Response, render_template, abort, url_for
+from flask import (Blueprint, Flask, request, jsonify, Response,
+                   render_template, abort, url_for, current_app)
 
 from flask_cors import CORS
 from prometheus_client import generate_latest, REGISTRY
 
-from wis2downloader import stop_event
-from wis2downloader.downloader import DownloadWorker
-from wis2downloader.log import LOGGER, setup_logger
-from wis2downloader.queue import SimpleQueue
-from wis2downloader.subscriber import MQTTSubscriber
-from wis2downloader.utils.validate_target import validate_target
+from wis2downloader.log import LOGGER
+from wis2downloader.runtime import Runtime, get_runtime
 from wis2downloader.utils.validate_topic import validate_topic
-from wis2downloader.utils.config import load_config
-
-CONFIG = load_config()
-
-
-setup_logger(loglevel=CONFIG['log_level'],
-             save=CONFIG['save_logs'],
-             log_path=CONFIG['log_path'])
-
-# Create the queue
-jobQ = SimpleQueue()
-
-# Now set up the different threads
-# 2) download workers
-# 3) subscriber
-
-# Start workers to process the jobs from the queue
-worker_threads = []
-
-for idx in range(CONFIG['download_workers']):
-    worker = DownloadWorker(jobQ, CONFIG['download_dir'],
-                            CONFIG['min_free_space'])
-    worker_thread = threading.Thread(target=worker.start, daemon=True)
-    worker_threads.append(worker_thread)
-    worker_thread.start()
-
-# Now create the MQTT subscriber
-mqtt_session = Path(CONFIG['mqtt_session_info'])
-if mqtt_session is None:
-    mqtt_session = ".mqtt_session.json"
-
-mqtt_session = Path(mqtt_session)
-if mqtt_session.is_file():
-    with open(mqtt_session) as fh:
-        session_info = json.load(fh)
-        if session_info.get('client_id') is None:
-            session_info['client_id'] = str(uuid4())
-else:
-    session_info = {
-        'topics': {},
-        'client_id': str(uuid4())
-    }
-
-LOGGER.info(session_info)
-
-subscriber = MQTTSubscriber(
-    CONFIG['broker_hostname'],
-    CONFIG['broker_port'],
-    CONFIG['broker_username'],
-    CONFIG['broker_password'],
-    CONFIG['broker_protocol'],
-    jobQ,
-    session_info['client_id']
-)
-
-# Now spawn subscriber as thread
-mqtt_thread = threading.Thread(target=subscriber.start, daemon=True)
-mqtt_thread.start()
-
-# Add default subscriptions
-for topic, target in session_info['topics'].items():
-    if CONFIG['validate_topics']:
-        is_topic_valid, _ = validate_topic(topic)
-    else:
-        is_topic_valid = True
-
-    if not is_topic_valid:
-        LOGGER.warning(
-            "Invalid topic in default config, please check config file")
-        continue
-
-    is_target_valid, _ = validate_target(target)
-    if not is_target_valid:
-        LOGGER.warning(
-            "Invalid target in default config, please check config file")
-        continue
-
-    subscriber.add_subscription(topic, target)
-
-# Provided the app.run() call is blocking, the following code will only
-# be executed when the Flask app is stopped
 
+api = Blueprint('api', __name__)
 
-def shutdown():
-    LOGGER.info("Shutting down")
 
-    # Stop the subscriber first
-    subscriber.stop()
+def current_runtime() -> Runtime:
+    return current_app.extensions['wis2downloader']
 
-    # Signal all other threads to stop
-    stop_event.set()
-
-    # now join mqtt thread
-    mqtt_thread.join()
-    LOGGER.info("Subscriber thread stopped")
-
-    for worker in worker_threads:
-        LOGGER.info("Shutting down worker threads")
-        # If download worker is blocked waiting for a job, send one
-        if jobQ.size() == 0:
-            jobQ.enqueue({'shutdown': True})
-        worker.join()
-
-
-# Create and run Flask instance
-
-app = Flask(__name__, instance_relative_config=True)
-CORS(app)
 
 # Define routes
 
 
-@app.route('/metrics')
+@api.route('/metrics')
 def expose_metrics():
     """
     Expose the Prometheus metrics to be scraped.
@@ -137,65 +31,101 @@ def expose_metrics():
     return Response(generate_latest(REGISTRY), mimetype="text/plain")
 
 
-@app.get('/subscriptions')
+@api.get('/subscriptions')
 def list_subscriptions():
-    subs = subscriber.list_subscriptions()
+    runtime = current_runtime()
+    subs = runtime.subscriber.list_subscriptions()
     return jsonify(subs)
 
 
-@app.post('/subscriptions')
+@api.post('/subscriptions')
 def add_subscription():
-    # Topic validation
+    runtime = current_runtime()
     if not request.is_json:
         abort(400, "Invalid input")
 
     data = request.json
-    topic = unquote(data.get("topic"))
+    subscription, msg = runtime.check_subscription(data)
+    if subscription is None:
+        abort(400, f"Invalid input ({msg})")
+
+    topic = subscription['topic']
     LOGGER.info(f"Subscribing to {topic}")
-    if CONFIG['validate_topics']:
-        is_topic_valid, msg = validate_topic(topic)
-    else:
-        is_topic_valid = True
-        msg = ''
+    try:
+        subs = runtime.subscriber.add_subscription(
+            topic, subscription['target'], subscription['share_group'],
+            subscription['filters'])
+    except ValueError as e:
+        abort(400, f"Invalid input ({e})")
+    except Exception as e:
+        abort(500, f"Internal server error: {e}")
 
-    if not is_topic_valid:
-        abort(400, f"Invalid input ({msg})")
+    try:
+        runtime.save_subscriptions([subscription])
+    except Exception as e:
+        abort(500, f"Internal server error: {e}")
 
-    # Target validation
-    target = data.get('target')
-    if target in (None, "$TOPIC"):
-        target = "$TOPIC"
+    response = jsonify(subs[topic])
+    response.status_code = 201
+    response.headers['Location'] = url_for('.get_subscription', topic=topic)
 
-    is_target_valid, msg = validate_target(target)
+    return response
 
-    if not is_target_valid:
-        abort(400, f"Invalid input ({msg})")
 
+@api.post('/subscriptions:batch')
+def add_subscriptions():
+    """
+    Add several subscriptions at once, all validated before subscribing to
+    any of them and saved to the session in a single write.
+    """
+    runtime = current_runtime()
+    if not request.is_json:
+        abort(400, "Invalid input")
+
+    data = request.json
+    items = data.get('subscriptions') if isinstance(data, dict) else None
+    if not isinstance(items, list) or len(items) == 0:
+        abort(400, "Invalid input (subscriptions must be a non-empty list)")
+
+    subscriptions = []
+    errors = []
+    for item in items:
+        subscription, msg = runtime.check_subscription(item)
+        if subscription is None:
+            topic = item.get('topic') if isinstance(item, dict) else item
+            errors.append(f"{topic}: {msg}")
+        else:
+            subscriptions.append(subscription)
+
+    if errors:
+        abort(400, f"Invalid input ({'; '.join(errors)})")
+
+    LOGGER.info(f"Subscribing to {len(subscriptions)} topics")
     try:
-        subs = subscriber.add_subscription(topic, target)
+        subs = runtime.subscriber.add_subscriptions(subscriptions)
+    except ValueError as e:
+        abort(400, f"Invalid input ({e})")
     except Exception as e:
         abort(500, f"Internal server error: {e}")
 
-    session_info['topics'][topic] = target
-
     try:
-        with open(CONFIG['mqtt_session_info'], 'w') as fh:
-            json.dump(session_info, fh)
+        runtime.save_subscriptions(subscriptions)
     except Exception as e:
         abort(500, f"Internal server error: {e}")
 
-    response = jsonify(subs[topic])
+    response = jsonify({subscription['topic']: subs[subscription['topic']]
+                        for subscription in subscriptions})
     response.status_code = 201
-    response.headers['Location'] = url_for('get_subscription', topic=topic)
 
     return response
 
 
-@app.get('/subscriptions/<path:topic>')
+@api.get('/subscriptions/<path:topic>')
 def get_subscription(topic):
+    runtime = current_runtime()
     # Topic validation
     topic = unquote(topic)
-    if CONFIG['validate_topics']:
+    if runtime.config['validate_topics']:
         is_topic_valid, msg = validate_topic(topic)
     else:
         is_topic_valid = True
@@ -204,17 +134,18 @@ def get_subscription(topic):
     if not is_topic_valid:
         abort(400, f"Invalid input ({msg})")
 
-    if topic not in subscriber.active_subscriptions:
+    if topic not in runtime.subscriber.active_subscriptions:
         abort(404, "Subscription not found")
 
-    return jsonify(subscriber.active_subscriptions[topic])
+    return jsonify(runtime.subscriber.active_subscriptions[topic])
 
 
-@app.delete('/subscriptions/<path:topic>')
+@api.delete('/subscriptions/<path:topic>')
 def delete_subscription(topic):
+    runtime = current_runtime()
     topic = unquote(topic)
     # Topic validation
-    if CONFIG['validate_topics']:
+    if runtime.config['validate_topics']:
         is_topic_valid, msg = validate_topic(topic)
     else:
         is_topic_valid = True
@@ -223,44 +154,95 @@ def delete_subscription(topic):
     if not is_topic_valid:
         abort(400, f"Invalid input ({msg})")
 
-    if topic not in subscriber.active_subscriptions:
+    if topic not in runtime.subscriber.active_subscriptions:
         abort(404, "Subscription not found")
 
-    subs = subscriber.delete_subscription(topic)
-
-    del session_info['topics'][topic]
+    subs = runtime.subscriber.delete_subscription(topic)
 
-    with open(CONFIG['mqtt_session_info'], 'w') as fh:
-        json.dump(session_info, fh)
+    runtime.remove_subscription(topic)
 
     return Response(response=json.dumps(subs), status=200,
                     mimetype="application/json")
 
 
-@app.route('/')
-@app.route('/swagger')
+@api.route('/')
+@api.route('/swagger')
 def render_swagger():
     return render_template('swagger.html', )
 
 
-@app.route('/openapi')
+@api.route('/openapi')
 def fetch_openapi():
-    p = Path(app.root_path) / 'static' / 'openapi.yaml'
+    runtime = current_runtime()
+    p = Path(current_app.root_path) / 'static' / 'openapi.yaml'
     with open(p) as fh:
         openapi_doc = yaml.safe_load(fh)
     openapi_doc['servers'] = [
-        {"url": CONFIG['base_url']}
+        {"url": runtime.config['base_url']}
     ]
     return jsonify(openapi_doc)
 
 
-@app.route('/health')
+@api.route('/health')
 def health_check():
     return Response(response=json.dumps({'status': 'healthy'}), status=200,
                     mimetype="application/json")
 
 
+def create_app(runtime: Runtime = None) -> Flask:
+    """
+    Create the Flask app, starting the runtime of the process if no runtime
+    is given. The runtime is shared by all the apps of a process, to be
+    served by a multi-threaded server, e.g.
+
+        gunicorn --workers 1 --threads 8 'wis2downloader.app:create_app()'
+    """
+    if runtime is None:
+        runtime = get_runtime()
+
+    app = Flask(__name__, instance_relative_config=True)
+    CORS(app)
+    app.extensions['wis2downloader'] = runtime
+    app.register_blueprint(api)
+
+    return app
+
+
+def __getattr__(name):
+    # The app used to be created on import, as wis2downloader.app:app
+    if name == 'app':
+        globals()['app'] = create_app()
+        return globals()['app']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def run():
-    app.run(debug=True, host=CONFIG['flask_host'],
-            port=CONFIG['flask_port'], use_reloader=False)
-    shutdown()
+    runtime = get_runtime()
+    app = create_app(runtime)
+    app.run(debug=True, host=runtime.config['flask_host'],
+            port=runtime.config['flask_port'], use_reloader=False)
+    runtime.shutdown()
+
+
+def serve(host: str = None, port: int = None, threads: int = 8):
+    """
+    Serve the app with a multi-threaded WSGI server, waitress if installed
+    and otherwise the threaded werkzeug server, until interrupted.
+    """
+    runtime = get_runtime()
+    app = create_app(runtime)
+    host = host or runtime.config['flask_host']
+    port = port or runtime.config['flask_port']
+    try:
+        try:
+            from waitress import serve as waitress_serve
+        except ImportError:
+            LOGGER.warning("waitress is not installed, using the werkzeug server")  # noqa
+            from werkzeug.serving import make_server
+            make_server(host, port, app, threaded=True).serve_forever()
+        else:
+            waitress_serve(app, host=host, port=port, threads=threads)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        runtime.shutdown()
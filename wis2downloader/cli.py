@@ -16,6 +16,17 @@ def run_dev(ctx):
     run()
 
 
+@click.command('serve')
+@click.option("--host", type=click.STRING, required=False, default=None, help="Host to listen on, flask_host if not given")  # noqa
+@click.option("--port", type=click.INT, required=False, default=None, help="Port to listen on, flask_port if not given")  # noqa
+@click.option("--threads", type=click.INT, required=False, default=8, help="Number of threads serving requests")  # noqa
+@click.pass_context
+def serve(ctx, host, port, threads):
+    """Run the wis2downloader with a multi-threaded server"""
+    from wis2downloader.app import serve
+    serve(host, port, threads)
+
+
 @click.command('list-subscriptions')
 @click.option("--host", type=click.STRING, required=False, default="localhost", help="Host the wis2downloader is running on")  # noqa
 @click.option("--port", type=click.INT, required=False, default=5000, help="Port the wis2downloader is running on")  # noqa
@@ -66,6 +77,47 @@ def add_subscription(ctx, host, port, topic):
         click.echo(f'Is the wis2downloader running on {DOWNLOAD_URL}?')
 
 
+@click.command('add-subscriptions')
+@click.pass_context
+@click.option("--host", type=click.STRING, required=False, default="localhost", help="Host the wis2downloader is running on")  # noqa
+@click.option("--port", type=click.INT, required=False, default=5000, help="Port the wis2downloader is running on")  # noqa
+@click.option('--topic', '-t', multiple=True, help='A topic to subscribe to, may be repeated')  # noqa
+@click.option('--file', '-f', 'topic_file', type=click.File(), required=False, help='File listing the topics to subscribe to, one per line')  # noqa
+@click.option('--target', required=False, default=None, help='Directory to save the data to, the topic if not given')  # noqa
+def add_subscriptions(ctx, host, port, topic, topic_file, target):
+    """add several subscriptions at once"""
+
+    topics = list(topic)
+    if topic_file is not None:
+        topics.extend(line.strip() for line in topic_file
+                      if line.strip() and not line.startswith('#'))
+    if not topics:
+        raise click.UsageError('Provide topics with --topic or --file')
+
+    subscriptions = [{'topic': topic_} for topic_ in topics]
+    if target is not None:
+        for subscription in subscriptions:
+            subscription['target'] = target
+
+    # make a POST request to http://{DOWNLOAD_URL}/subscriptions:batch
+    DOWNLOAD_URL = f"http://{host}:{port}"
+    try:
+        response = requests.post(f'{DOWNLOAD_URL}/subscriptions:batch',
+                                 json={'subscriptions': subscriptions})
+        # check response status
+        if response.status_code == 201:
+            click.echo(f'{len(subscriptions)} subscriptions added')
+            click.echo('Added subscriptions:')
+            click.echo(response.text)
+        else:
+            click.echo('Subscriptions not added')
+            click.echo(f'Error: {response.status_code}')
+            click.echo(response.text)
+    except requests.exceptions.ConnectionError:
+        click.echo('Error: Connection refused')
+        click.echo(f'Is the wis2downloader running on {DOWNLOAD_URL}?')
+
+
 @click.command('remove-subscription')
 @click.pass_context
 @click.option("--host", type=click.STRING, required=False, default="localhost", help="Host the wis2downloader is running on")  # noqa
@@ -96,6 +148,8 @@ def remove_subscription(ctx, host, port, topic):
 
 
 cli.add_command(run_dev)
+cli.add_command(serve)
 cli.add_command(list_subscriptions)
 cli.add_command(add_subscription)
+cli.add_command(add_subscriptions)
 cli.add_command(remove_subscription)
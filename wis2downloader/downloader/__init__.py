@@ -1,19 +1,35 @@
 from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Optional
 import urllib3
 from urllib.parse import urlsplit
 import hashlib
 import base64
+import binascii
+import gzip
 import os
-from datetime import datetime as dt
+from datetime import datetime as dt, timezone
 from pathlib import Path
 import enum
 import shutil
+import tempfile
+import time
 
 from wis2downloader import stop_event
+from wis2downloader.downloader.breaker import CircuitBreaker
+from wis2downloader.downloader.index import DownloadIndex
+from wis2downloader.downloader.inflight import InFlightRegistry
+from wis2downloader.downloader.retry import RetryPolicy, parse_retry_after
+from wis2downloader.downloader.sources import SourceStats
 from wis2downloader.log import LOGGER
-from wis2downloader.queue import BaseQueue
-from wis2downloader.metrics import (DOWNLOADED_BYTES, DOWNLOADED_FILES,
-                                    FAILED_DOWNLOADS)
+from wis2downloader.queue import BaseQueue, DelayQueue
+from wis2downloader.metrics import (
+    COALESCED_DOWNLOADS, DOWNLOADED_BYTES, DOWNLOADED_FILES,
+    DOWNLOAD_TRANSFER_SECONDS, DOWNLOAD_TTFB_SECONDS, DOWNLOAD_VERIFY_SECONDS,
+    DOWNLOAD_WRITE_SECONDS, FAILED_DOWNLOADS, INLINE_DOWNLOADS,
+    NOTIFICATION_TO_DISK_SECONDS, QUEUE_WAIT_SECONDS, RETRIES_ABANDONED,
+    RETRIES_SCHEDULED, RETRIES_SUCCEEDED)
 
 
 class BaseDownloader(ABC):
@@ -26,7 +42,8 @@ class BaseDownloader(ABC):
 
     @abstractmethod
     def process_job(self, job):
-        """Process a single job from the queue"""
+        """Process a single job from the queue. Returns True if the job was
+        handed to the delay queue, which then acknowledges it"""
         pass
 
     @abstractmethod
@@ -59,7 +76,8 @@ class BaseDownloader(ABC):
 
     @abstractmethod
     def save_file(self, data, target, filename, filesize, download_start):
-        """Save the downloaded data to disk"""
+        """Save the downloaded data to disk, returning whether they were
+        saved"""
 
 
 def get_todays_date():
@@ -87,6 +105,81 @@ def map_media_type(media_type):
     return _map.get(media_type, 'bin')
 
 
+def decode_content(content):
+    """
+    Decode data embedded in a notification, given as an (encoding, value,
+    size) tuple. Returns None if the content can't be decoded or is
+    truncated.
+    """
+    if content is None:
+        return None
+    encoding, value, size = content
+    try:
+        if encoding == 'utf-8':
+            data = value.encode('utf-8')
+        elif encoding == 'base64':
+            data = base64.b64decode(value, validate=True)
+        elif encoding == 'gzip':
+            data = gzip.decompress(base64.b64decode(value, validate=True))
+        else:
+            return None
+    except (binascii.Error, ValueError, OSError, EOFError) as e:
+        LOGGER.debug(f"Unable to decode {encoding} content: {e}")
+        return None
+
+    if size is not None and len(data) != size:
+        return None
+
+    return data
+
+
+def parse_pubtime(value) -> Optional[float]:
+    """Parse the pubtime of a notification, an RFC 3339 date time, into
+    seconds since the epoch. Returns None if it can't be parsed"""
+    if not value:
+        return None
+    value = value.replace('Z', '+00:00').replace('z', '+00:00')
+    # fromisoformat only accepts up to microseconds
+    if '.' in value:
+        seconds, _, fraction = value.partition('.')
+        digits = len(fraction) - len(fraction.lstrip('0123456789'))
+        fraction = fraction[:digits][:6].ljust(6, '0') + fraction[digits:]
+        value = f"{seconds}.{fraction}"
+    try:
+        published = dt.fromisoformat(value)
+    except ValueError:
+        return None
+    if published.tzinfo is None:
+        published = published.replace(tzinfo=timezone.utc)
+    return published.timestamp()
+
+
+# NamedTemporaryFile creates files readable by the owner only, partial
+# downloads are given the permissions open() would have given them
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def run_sync(coro):
+    """
+    Run a coroutine of the download orchestration to completion without an
+    event loop. The threaded worker's transport never suspends, so the
+    coroutine completes on its first step.
+    """
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise RuntimeError("Download coroutine suspended outside an event loop")
+
+
+async def iterate(chunks):
+    """Asynchronous iterator over a blocking iterable"""
+    for chunk in chunks:
+        yield chunk
+
+
 class VerificationMethods(enum.Enum):
     sha256 = 'sha256'
     sha384 = 'sha384'
@@ -96,52 +189,480 @@ class VerificationMethods(enum.Enum):
     sha3_512 = 'sha3_512'
 
 
+class PartialFile:
+    """Temporary file beside the download target that data are streamed to.
+    The data are hashed as they are written so the download can be verified
+    without reading it back"""
+    def __init__(self, task):
+        self.target = task.target
+        self.verify = None not in (task.expected_hash, task.hash_function)
+        self.hasher = task.hash_function() if self.verify else None
+        self.size = 0
+        # Time spent writing to disk, excluding hashing
+        self.write_seconds = 0.0
+        self.path = None
+        self.fh = None
+
+    def __enter__(self):
+        self.fh = tempfile.NamedTemporaryFile(
+            dir=self.target.parent, prefix=f".{self.target.name}.",
+            suffix=".part", delete=False)
+        self.path = Path(self.fh.name)
+        os.chmod(self.path, 0o666 & ~_UMASK)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.fh.close()
+
+    def write(self, chunk) -> None:
+        if self.verify:
+            self.hasher.update(chunk)
+        self.size += len(chunk)
+        write_start = time.monotonic()
+        self.fh.write(chunk)
+        self.write_seconds += time.monotonic() - write_start
+
+    def digest(self) -> bytes:
+        return self.hasher.digest()
+
+    def commit(self) -> None:
+        os.replace(self.path, self.target)
+        self.path = None
+
+    def discard(self) -> None:
+        if self.path is None:
+            return
+        try:
+            self.path.unlink(missing_ok=True)
+        except Exception as e:
+            LOGGER.error(f"Error removing partial download {self.path}")
+            LOGGER.error(e)
+        self.path = None
+
+
+@dataclass
+class DownloadTask:
+    """Details of a single download, extracted from a job"""
+    url: str
+    target: Path
+    filename: str
+    update: bool
+    data_id: str
+    expected_hash: str
+    hash_function: Callable
+    expected_size: int
+    topic: str
+    centre_id: str
+    file_type_label: str
+    index_key: str = None
+    # Equivalent sources for the data, best first
+    sources: list = field(default_factory=list)
+    # Timings of the last attempt, in seconds
+    ttfb: float = None
+    transfer_seconds: float = None
+    # Publication time of the notification, seconds since the epoch
+    published: float = None
+    # Whether a failed download is worth trying again, and when
+    retryable: bool = False
+    retry_after: float = None
+    # Whether the last attempt failed because of the data rather than the
+    # source, e.g. failing verification
+    data_error: bool = False
+
+
 class DownloadWorker(BaseDownloader):
-    def __init__(self, queue: BaseQueue, basepath: str = ".", min_free_space=10):  # noqa
-        timeout = urllib3.Timeout(connect=1.0)
+    def __init__(self, queue: BaseQueue, basepath: str = ".", min_free_space=10,  # noqa
+                 stream: bool = False, chunk_size: int = 1048576,
+                 index: Optional[DownloadIndex] = None,
+                 in_flight: Optional[InFlightRegistry] = None,
+                 coalesce_timeout: float = 60,
+                 source_stats: Optional[SourceStats] = None,
+                 breaker: Optional[CircuitBreaker] = None,
+                 delay_queue: Optional[DelayQueue] = None,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 connect_timeout: float = 1.0,
+                 read_timeout: Optional[float] = None,
+                 deadline: Optional[float] = None):
+        # The read timeout limits how long a stalled download blocks the
+        # worker, the deadline limits the total time of a download. urllib3
+        # has no limit on the time to read the whole body, the deadline is
+        # checked as each chunk arrives
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        timeout = urllib3.Timeout(connect=connect_timeout, read=read_timeout)
         self.http = urllib3.PoolManager(timeout=timeout)
         self.queue = queue
         self.basepath = Path(basepath)
         self.min_free_space = min_free_space * 1073741824  # GBytes
-        self.status = "ready"
+        # When streaming, the response body is read chunk_size bytes at a
+        # time and written to a temporary file rather than held in memory
+        self.stream = stream
+        self.chunk_size = chunk_size
+        # Index of data already downloaded, shared between workers. Without
+        # one, duplicates are detected by the target file existing
+        self.index = index
+        # Downloads in progress, shared between workers so that the same
+        # data published by several global caches are only fetched once
+        self.in_flight = in_flight
+        self.coalesce_timeout = coalesce_timeout
+        # Rolling per host statistics, shared between workers, used to pick
+        # the fastest of several sources for the same data
+        self.source_stats = source_stats
+        # Per host circuit breaker, shared between workers. Jobs whose
+        # sources are all unavailable are put on the delay queue
+        self.breaker = breaker
+        self.delay_queue = delay_queue
+        # Failed downloads are put on the delay queue to be tried again,
+        # following the retry policy
+        self.retry_policy = retry_policy
+        # Set by the watchdog if the worker is stuck, the worker then stops
+        # once the current job returns
+        self.abandoned = False
+        # Flights the worker leads, by key, with their tasks
+        self.leading = {}
+        self.set_status("ready")
+
+    def set_status(self, status) -> None:
+        self.status = status
+        self.status_since = time.monotonic()
 
     def start(self) -> None:
         LOGGER.info("Starting download worker")
-        while not stop_event.is_set():
-            # First get the job from the queue
-            job = self.queue.dequeue()
-            if job.get('shutdown', False):
-                break
+        while not stop_event.is_set() and not self.abandoned:
+            # First get a job from the queue, waking periodically to check
+            # whether the worker should stop. Only one is taken at a time,
+            # jobs held while another downloads would wait for no reason
+            # and could be reclaimed by other nodes
+            jobs = self.queue.dequeue_many(1, timeout=1)
+            if not jobs:
+                continue
+            job = jobs[0]
+            if job.shutdown:
+                return
+            if stop_event.is_set() or self.abandoned:
+                self.return_jobs(jobs)
+                return
 
-            self.status = "running"
+            self.set_status("running")
+            delayed = False
             try:
-                self.process_job(job)
+                delayed = self.process_job(job)
             except Exception as e:
                 LOGGER.error(e)
 
-            self.status = "ready"
-            self.queue.task_done()
+            self.set_status("ready")
+            if not delayed:
+                self.queue.task_done(job)
+
+    def abandon(self) -> None:
+        """Called by the watchdog when the worker is stuck. The downloads
+        the worker leads are counted as failed and released, so that jobs
+        waiting on them try themselves"""
+        self.abandoned = True
+        for key in list(self.leading):
+            claim = self.leading.pop(key, None)
+            if claim is None:
+                continue
+            task, flight = claim
+            LOGGER.error(f"Abandoning download of {task.filename}")
+            self.record_failure(task)
+            self.in_flight.release(key, flight, False)
+
+    def return_jobs(self, jobs) -> None:
+        """Put jobs taken from the queue but not started back on it"""
+        if not jobs:
+            return
+        self.queue.enqueue_many(jobs)
+        for job in jobs:
+            self.queue.task_done(job)
 
     def get_free_space(self):
         total, used, free = shutil.disk_usage(self.basepath)
         return free
 
-    def process_job(self, job) -> None:
+    def process_job(self, job) -> bool:
+        return self.call(self.aprocess_job(job))
+
+    def download(self, task, flight=None):
+        """Download the task, trying each known source for the data in turn
+        until one succeeds. Returns None if no source could be tried"""
+        return self.call(self.adownload(task, flight))
+
+    def fetch(self, task):
+        """Download the task from task.url, returning the file size or None
+        on failure"""
+        return self.call(self.afetch(task))
+
+    # The download orchestration is written as coroutines shared by all
+    # workers. Only the transport hooks below differ: those of the threaded
+    # worker block and never suspend, so it runs the coroutines with
+    # run_sync, an asynchronous worker overrides them to await the network
+    # and run blocking calls off its event loop.
+
+    def call(self, coro):
+        """Run a download coroutine to completion from synchronous code"""
+        return run_sync(coro)
+
+    async def run_blocking(self, func, *args):
+        """Call func(*args), which may block on the disk or a database"""
+        return func(*args)
+
+    async def wait_for(self, flight) -> bool:
+        """Wait for a download by another job, returning False if
+        coalesce_timeout expires first"""
+        return flight.wait(self.coalesce_timeout)
+
+    @asynccontextmanager
+    async def open_url(self, url):
+        """GET the url, giving the status code, the headers and an
+        asynchronous iterator over chunks of the response body"""
+        response = self.http.request('GET', url, preload_content=False)
+        try:
+            yield (response.status, response.headers,
+                   iterate(response.stream(self.chunk_size)))
+        finally:
+            response.release_conn()
+
+    async def aprocess_job(self, job) -> bool:
+        self.record_queue_wait(job)
+        task = await self.run_blocking(self.prepare_task, job)
+        if task is None:
+            return False
+
+        if job.content is not None and \
+                await self.run_blocking(self.save_inline, job, task):
+            return self.complete(job, task, True)
+
+        # Don't tie up the worker with hosts known to be down
+        if not self.has_available_source(task):
+            return self.defer(job, task)
+
+        if self.in_flight is None or task.index_key is None:
+            return self.complete(job, task, await self.adownload(task))
+
+        flight = None
+        while True:
+            claimed, leader = self.in_flight.claim(task.index_key)
+            if leader:
+                flight = claimed
+                break
+            # Another worker is already downloading these data. Offer it our
+            # sources, wait for it and only try ourselves if it fails
+            claimed.add_sources(task.sources)
+            if not await self.wait_for(claimed):
+                # Rather than lose the job to a stalled download, try
+                # ourselves outside the flight
+                LOGGER.warning(f"Timed out waiting for another worker to download {task.filename}, downloading")  # noqa
+                break
+            if not claimed.success:
+                continue
+            self.record_coalesced(task)
+            return False
+
+        if flight is None:
+            return self.complete(job, task, await self.adownload(task))
+
+        self.leading[task.index_key] = (task, flight)
+        result = False
+        try:
+            # The download may have completed between preparing the task and
+            # claiming the flight
+            if await self.run_blocking(self.is_duplicate, task.index_key,
+                                       task.target, task.update):
+                LOGGER.info(f"Skipping download of {task.filename}, already exists")  # noqa
+                result = True
+            else:
+                result = await self.adownload(task, flight)
+        finally:
+            # Unless the watchdog already gave up on the download
+            if self.leading.pop(task.index_key, None) is not None:
+                self.in_flight.release(task.index_key, flight, bool(result))
+
+        return self.complete(job, task, result)
+
+    def complete(self, job, task, result) -> bool:
+        """Act on the result of downloading a job: None if no source could
+        be tried, otherwise whether the download succeeded. Returns whether
+        the job was handed to the delay queue"""
+        attempt = job.attempt
+        if result is None:
+            return self.defer(job, task)
+        elif result:
+            if attempt > 0:
+                RETRIES_SUCCEEDED.labels(
+                    topic=task.topic, centre_id=task.centre_id).inc(1)
+        elif task.retryable:
+            return self.retry(job, task)
+        return False
+
+    def retry(self, job, task) -> bool:
+        """Schedule another attempt at a failed job, with backoff"""
+        if self.retry_policy is None or self.delay_queue is None:
+            return False
+        attempt = job.attempt
+        if not self.retry_policy.should_retry(attempt):
+            LOGGER.warning(f"Giving up on {task.filename} after {attempt + 1} attempts")  # noqa
+            RETRIES_ABANDONED.labels(
+                topic=task.topic, centre_id=task.centre_id).inc(1)
+            return False
+        attempt += 1
+        delay = self.retry_policy.delay(attempt, task.retry_after)
+        LOGGER.info(f"Retrying {task.filename} in {delay:.1f} seconds (attempt {attempt + 1})")  # noqa
+        job.attempt = attempt
+        self.delay_queue.schedule(job, delay)
+        RETRIES_SCHEDULED.labels(
+            topic=task.topic, centre_id=task.centre_id).inc(1)
+        return True
+
+    async def adownload(self, task, flight=None):
+        # Check free space up front, there is no point fetching a file that
+        # will be discarded
+        if not await self.run_blocking(self.has_free_space, task.data_id,
+                                       task.expected_size or 0):
+            self.record_failure(task)
+            return False
+
+        task.retryable = False
+        task.retry_after = None
+        tried = set()
+        url = self.next_source(task, tried, flight)
+        if url is None:
+            return None
+        while url is not None:
+            tried.add(url)
+            task.url = url
+            task.data_error = False
+            filesize = await self.afetch(task)
+            if filesize is not None:
+                self.record_source(task, filesize)
+                return True
+            if task.data_error:
+                # The host answered, don't hold the data against it
+                if self.breaker is not None:
+                    self.breaker.record_success(url)
+            else:
+                self.record_source_failure(url)
+            url = self.next_source(task, tried, flight)
+            if url is not None:
+                LOGGER.info(f"Retrying download of {task.filename} from {url}")  # noqa
+
+        return False
+
+    async def afetch(self, task):
+        # Start timer of download time to be logged later
+        download_start = dt.now()
+
+        if self.stream:
+            filesize = await self.astream_to_file(task)
+            if filesize is None:
+                return None
+            self.log_download(task, filesize, download_start)
+        else:
+            filesize = await self.adownload_to_memory(task, download_start)
+            if filesize is None:
+                return None
+
+        await self.run_blocking(self.record_download, task, filesize)
+        return filesize
+
+    def next_source(self, task, tried, flight=None):
+        """Return the best source for the task not yet tried, including
+        sources offered by other jobs for the same data"""
+        candidates = list(task.sources)
+        if flight is not None:
+            candidates.extend(flight.sources)
+        candidates = [url for url in dict.fromkeys(candidates)
+                      if url not in tried]
+        if not candidates:
+            return None
+        if self.source_stats is not None:
+            candidates = self.source_stats.rank(candidates,
+                                                task.expected_size)
+        for url in candidates:
+            if self.breaker is None or self.breaker.allow(url):
+                return url
+        return None
+
+    def has_available_source(self, task) -> bool:
+        if self.breaker is None:
+            return True
+        return any(self.breaker.is_available(url) for url in task.sources)
+
+    def defer(self, job, task) -> bool:
+        """Put a job whose sources are all unavailable back on the queue once
+        the first of them may be tried again. Deferrals count as attempts,
+        so the job is abandoned once the retry policy's attempts (or its
+        default, without a policy) are used up"""
+        if self.delay_queue is None:
+            LOGGER.warning(f"No source available for {task.filename}, discarding")  # noqa
+            self.record_failure(task)
+            return False
+        policy = self.retry_policy or RetryPolicy()
+        if not policy.should_retry(job.attempt):
+            LOGGER.warning(f"No source available for {task.filename}, giving up after {job.attempt + 1} attempts")  # noqa
+            self.record_failure(task)
+            RETRIES_ABANDONED.labels(
+                topic=task.topic, centre_id=task.centre_id).inc(1)
+            return False
+        # Wait at least a second, a half open host may be being probed
+        delay = max(1.0, min(self.breaker.retry_after(url)
+                             for url in task.sources))
+        LOGGER.info(f"No source available for {task.filename}, deferring for {delay:.1f} seconds")  # noqa
+        job.attempt += 1
+        self.delay_queue.schedule(job, delay)
+        return True
+
+    def record_source(self, task, filesize) -> None:
+        if self.breaker is not None:
+            self.breaker.record_success(task.url)
+        if self.source_stats is None or task.ttfb is None:
+            return
+        self.source_stats.record_success(task.url, task.ttfb, filesize,
+                                         task.transfer_seconds or 0)
+
+    def record_source_failure(self, url) -> None:
+        if self.breaker is not None:
+            self.breaker.record_failure(url)
+        if self.source_stats is not None:
+            self.source_stats.record_failure(url)
+
+    def is_duplicate(self, index_key, target, update) -> bool:
+        if update:
+            return False
+        if self.index is not None and index_key is not None:
+            if self.index.contains(index_key):
+                return True
+            # Files saved before the index was created, e.g. before a
+            # restart with an in-memory index, are indexed when found
+            if target.is_file():
+                self.index.add(index_key)
+                return True
+            return False
+        return target.is_file()
+
+    def prepare_task(self, job):
+        """Work out what to download for a job and where to save it.
+        Returns None if there is nothing to download"""
         yyyy, mm, dd = get_todays_date()
         output_dir = self.basepath / yyyy / mm / dd
 
         # Add target to output directory
-        output_dir = output_dir / job.get("target", ".")
+        output_dir = output_dir / job.target
 
         # Get information about the job for verification later
         expected_hash, hash_function = self.get_hash_info(job)
 
-        # Get the download url, update status, and file type from the job links
-        _url, update, media_type, expected_size = self.get_download_url(job)
+        # Get the download urls, update status, and file type from the job
+        # links, fastest source first
+        urls, update, media_type, expected_size = self.get_download_links(job)
+        if self.source_stats is not None:
+            urls = self.source_stats.rank(urls, expected_size)
+        _url = urls[0] if urls else None
 
         if _url is None:
             LOGGER.warning(f"No download link found in job {job}")
-            return
+            return None
 
         # map media type to file extension
         file_type = map_media_type(media_type)
@@ -149,18 +670,20 @@ class DownloadWorker(BaseDownloader):
         # Global caches can set whatever filename they want, we need to use
         # the data_id for uniqueness. However, this can be unwieldy, hence use
         # hash of data_id
-        data_id = job.get('payload', {}).get('properties', {}).get('data_id')
+        data_id = job.data_id
         filename, _ = self.extract_filename(_url)
         filename = filename + '.' + file_type
         target = output_dir / filename
-        # Create parent dir if it doesn't exist
-        target.parent.mkdir(parents=True, exist_ok=True)
 
-        # Only download if file doesn't exist or is an update
-        is_duplicate = target.is_file() and not update
-        if is_duplicate:
+        # Only download if not already downloaded to this target or is an
+        # update
+        index_key = DownloadIndex.make_key(data_id, expected_hash, job.target)
+        if self.is_duplicate(index_key, target, update):
             LOGGER.info(f"Skipping download of {filename}, already exists")
-            return
+            return None
+
+        # Create parent dir if it doesn't exist
+        target.parent.mkdir(parents=True, exist_ok=True)
 
         # Get information needed for download metric labels
         topic, centre_id = self.get_topic_and_centre(job)
@@ -174,70 +697,237 @@ class DownloadWorker(BaseDownloader):
                 file_type_label = label
                 break
 
-        # Start timer of download time to be logged later
-        download_start = dt.now()
+        return DownloadTask(
+            url=_url, target=target, filename=filename, update=update,
+            data_id=data_id, expected_hash=expected_hash,
+            hash_function=hash_function, expected_size=expected_size,
+            topic=topic, centre_id=centre_id,
+            file_type_label=file_type_label, index_key=index_key,
+            sources=urls, published=parse_pubtime(job.pubtime))
+
+    def save_inline(self, job, task) -> bool:
+        """Save the data embedded in the notification, verified as for a
+        download. Returns False if they can't be used, e.g. as they are
+        truncated, in which case the data should be downloaded"""
+        data = decode_content(job.content)
+        if data is None:
+            return False
+        if task.expected_size is not None and len(data) != task.expected_size:
+            return False
+        if not self.validate_data(data, task.expected_hash,
+                                  task.hash_function, task.expected_size):
+            LOGGER.warning(f"Content embedded in notification for {task.data_id} failed verification, downloading")  # noqa
+            return False
+        if not self.has_free_space(task.data_id, len(data)):
+            return False
 
-        # Download the file
-        response = None
-        try:
-            response = self.http.request('GET', _url)
-            # Check the response status code
-            if response.status != 200:
-                LOGGER.error(f"Error downloading {_url}, received status code: {response.status}")
-                # Increment failed download counter
-                FAILED_DOWNLOADS.labels(topic=topic, centre_id=centre_id).inc(1)
-                return
-            # Get the filesize in KB
-            filesize = len(response.data)
-        except Exception as e:
-            LOGGER.error(f"Error downloading {_url}")
-            LOGGER.error(e)
-            # Increment failed download counter
-            FAILED_DOWNLOADS.labels(topic=topic, centre_id=centre_id).inc(1)
-            return
+        if not self.save_file(data, task.target, task.filename, len(data),
+                              dt.now()):
+            return False
+        self.record_download(task, len(data))
+        INLINE_DOWNLOADS.labels(
+            topic=task.topic, centre_id=task.centre_id).inc(1)
+        return True
 
+    def record_queue_wait(self, job) -> None:
+        if job.queued_at is not None:
+            QUEUE_WAIT_SECONDS.observe(max(0.0, time.time() - job.queued_at))
+
+    def record_download(self, task, filesize) -> None:
+        if self.index is not None:
+            self.index.add(task.index_key)
+        if task.ttfb is not None:
+            DOWNLOAD_TTFB_SECONDS.observe(task.ttfb)
+        if task.transfer_seconds is not None:
+            DOWNLOAD_TRANSFER_SECONDS.observe(task.transfer_seconds)
+        if task.published is not None:
+            # Clocks may disagree, don't record negative latencies
+            NOTIFICATION_TO_DISK_SECONDS.labels(
+                centre_id=task.centre_id).observe(
+                    max(0.0, time.time() - task.published))
+        DOWNLOADED_BYTES.labels(
+            topic=task.topic, centre_id=task.centre_id,
+            file_type=task.file_type_label).inc(filesize)
+        DOWNLOADED_FILES.labels(
+            topic=task.topic, centre_id=task.centre_id,
+            file_type=task.file_type_label).inc(1)
+
+    def record_coalesced(self, task) -> None:
+        LOGGER.info(f"Skipping download of {task.filename}, already downloaded by another worker")  # noqa
+        COALESCED_DOWNLOADS.labels(
+            topic=task.topic, centre_id=task.centre_id).inc(1)
+
+    def record_failure(self, task, retryable=False, retry_after=None) -> None:
+        FAILED_DOWNLOADS.labels(
+            topic=task.topic, centre_id=task.centre_id).inc(1)
+        task.retryable = task.retryable or retryable
+        if retry_after is not None:
+            task.retry_after = max(task.retry_after or 0, retry_after)
+
+    def record_http_failure(self, task, status, headers) -> None:
+        if self.retry_policy is not None:
+            retryable = self.retry_policy.is_retryable_status(status)
+        else:
+            retryable = False
+        self.record_failure(task, retryable,
+                            parse_retry_after(headers.get('Retry-After')))
+
+    def log_download(self, task, filesize, download_start) -> None:
+        download_seconds = round(
+            (dt.now() - download_start).total_seconds(), 2)
+        LOGGER.info(
+            f"Downloaded {task.filename} of size {filesize} bytes in {download_seconds} seconds")  # noqa
+
+    def has_free_space(self, data_id, filesize=0) -> bool:
         if self.min_free_space > 0:  # only check size if limit set
             free_space = self.get_free_space()
             if free_space < self.min_free_space:
                 LOGGER.warning(f"Too little free space, {free_space - filesize} < {self.min_free_space} , file {data_id} not saved")  # noqa
-                FAILED_DOWNLOADS.labels(topic=topic, centre_id=centre_id).inc(1)
-                return
+                return False
+        return True
+
+    async def adownload_to_memory(self, task, download_start):
+        """Download the whole response body into memory, verify it and
+        save it to the target. Returns the file size or None on failure"""
+        try:
+            request_start = time.monotonic()
+            async with self.open_url(task.url) as (status, headers, body):
+                task.ttfb = time.monotonic() - request_start
+                # Check the response status code
+                if status != 200:
+                    LOGGER.error(f"Error downloading {task.url}, received status code: {status}")  # noqa
+                    # Increment failed download counter
+                    self.record_http_failure(task, status, headers)
+                    return None
+                data = bytearray()
+                async for chunk in body:
+                    self.check_deadline(task, request_start)
+                    data.extend(chunk)
+                    self.check_size(task, len(data))
+            task.transfer_seconds = time.monotonic() - request_start - \
+                task.ttfb
+        except Exception as e:
+            LOGGER.error(f"Error downloading {task.url}")
+            LOGGER.error(e)
+            # Increment failed download counter
+            self.record_failure(task, retryable=True)
+            return None
+
+        if not await self.run_blocking(self.verify_and_save, task, data,
+                                       download_start):
+            return None
+
+        return len(data)
 
-        if response is None:
-            FAILED_DOWNLOADS.labels(topic=topic, centre_id=centre_id).inc(1)
+    def check_size(self, task, size) -> None:
+        """Abandon a download once more data than announced have arrived"""
+        if task.expected_size is not None and size > task.expected_size:
+            task.data_error = True
+            raise ValueError(
+                f"Download of {task.url} exceeded expected size of {task.expected_size} bytes")  # noqa
+
+    def check_deadline(self, task, request_start) -> None:
+        if self.deadline is None:
             return
+        if time.monotonic() - request_start > self.deadline:
+            raise TimeoutError(
+                f"Download of {task.url} exceeded deadline of {self.deadline} seconds")  # noqa
 
+    def verify_and_save(self, task, data, download_start) -> bool:
+        """Check the integrity of data held in memory and, if it passes,
+        save it to the target. Returns whether the data were saved"""
         # Use the hash function to determine whether to save the data
         save_data = self.validate_data(
-            response.data, expected_hash, hash_function, expected_size)
+            data, task.expected_hash, task.hash_function, task.expected_size)
 
         if not save_data:
-            LOGGER.warning(f"Download {data_id} failed verification, discarding")  # noqa
+            LOGGER.warning(f"Download {task.data_id} failed verification, discarding")  # noqa
             # Increment failed download counter
-            FAILED_DOWNLOADS.labels(topic=topic, centre_id=centre_id).inc(1)
-            return
+            task.data_error = True
+            self.record_failure(task, retryable=True)
+            return False
 
         # Now save
-        self.save_file(response.data, target, filename,
-                       filesize, download_start)
+        if not self.save_file(data, task.target, task.filename,
+                              len(data), download_start):
+            task.data_error = True
+            self.record_failure(task)
+            return False
 
-        # Increment metrics
-        DOWNLOADED_BYTES.labels(
-            topic=topic, centre_id=centre_id,
-            file_type=file_type_label).inc(filesize)
-        DOWNLOADED_FILES.labels(
-            topic=topic, centre_id=centre_id,
-            file_type=file_type_label).inc(1)
+        return True
+
+    async def astream_to_file(self, task):
+        """Stream the response body to a temporary file beside the target,
+        hashing it as it arrives, and move it into place once verified.
+        Returns the file size or None on failure"""
+        writer = PartialFile(task)
+        try:
+            request_start = time.monotonic()
+            async with self.open_url(task.url) as (status, headers, body):
+                task.ttfb = time.monotonic() - request_start
+                if status != 200:
+                    LOGGER.error(f"Error downloading {task.url}, received status code: {status}")  # noqa
+                    self.record_http_failure(task, status, headers)
+                    return None
+
+                with writer:
+                    async for chunk in body:
+                        self.check_deadline(task, request_start)
+                        await self.run_blocking(writer.write, chunk)
+                        self.check_size(task, writer.size)
+            task.transfer_seconds = time.monotonic() - request_start - \
+                task.ttfb
+        except Exception as e:
+            LOGGER.error(f"Error downloading {task.url}")
+            LOGGER.error(e)
+            self.record_failure(task, retryable=True)
+            writer.discard()
+            return None
+
+        if not await self.run_blocking(self.commit_partial, task, writer):
+            return None
+
+        return writer.size
+
+    def commit_partial(self, task, writer) -> bool:
+        """Verify a streamed download and move it into place"""
+        if writer.verify:
+            # The data were hashed as they arrived, only the digest is left
+            verify_start = time.monotonic()
+            valid = self.validate_digest(
+                writer.digest(), writer.size, task.expected_hash,
+                task.expected_size)
+            DOWNLOAD_VERIFY_SECONDS.observe(time.monotonic() - verify_start)
+            if not valid:
+                LOGGER.warning(f"Download {task.data_id} failed verification, discarding")  # noqa
+                task.data_error = True
+                self.record_failure(task, retryable=True)
+                writer.discard()
+                return False
+
+        try:
+            write_start = time.monotonic()
+            writer.commit()
+            # The data were written as they arrived, add the time taken
+            DOWNLOAD_WRITE_SECONDS.observe(
+                writer.write_seconds + time.monotonic() - write_start)
+        except Exception as e:
+            LOGGER.error(f"Error saving to disk: {task.target}")
+            LOGGER.error(e)
+            task.data_error = True
+            self.record_failure(task)
+            writer.discard()
+            return False
+
+        return True
 
     def get_topic_and_centre(self, job) -> tuple:
-        topic = job.get('topic')
+        topic = job.topic
         return topic, topic.split('/')[3]
 
     def get_hash_info(self, job):
-        expected_hash = job.get('payload', {}).get(
-            'properties', {}).get('integrity', {}).get('value')
-        hash_method = job.get('payload', {}).get(
-            'properties', {}).get('integrity', {}).get('method')
+        expected_hash = job.hash_value
+        hash_method = job.hash_method
 
         hash_function = None
 
@@ -251,25 +941,29 @@ class DownloadWorker(BaseDownloader):
         return expected_hash, hash_function
 
     def get_download_url(self, job) -> tuple:
-        links = job.get('payload', {}).get('links', [])
-        _url = None
-        update = False
+        urls, update, media_type, expected_size = self.get_download_links(job)
+        if self.source_stats is not None:
+            urls = self.source_stats.rank(urls, expected_size)
+        _url = urls[0] if urls else None
+        return _url, update, media_type, expected_size
+
+    def get_download_links(self, job) -> tuple:
+        """Extract all download urls for the data, with the update status
+        and file type. Update links take precedence over canonical links"""
+        update_links = [link for link in job.links if link[0] == 'update']
+        canonical_links = [link for link in job.links
+                           if link[0] == 'canonical']
+
+        update = len(update_links) > 0
+        links = update_links if update else canonical_links
+        urls = [href for _, href, _, _ in links if href]
+
         media_type = None
         expected_size = None
-        for link in links:
-            if link.get('rel') == 'update':
-                _url = link.get('href')
-                media_type = link.get('type')
-                expected_size = link.get('length')
-                update = True
-                break
-            elif link.get('rel') == 'canonical':
-                _url = link.get('href')
-                media_type = link.get('type')
-                expected_size = link.get('length')
-                break
+        if links:
+            _, _, media_type, expected_size = links[0]
 
-        return _url, update, media_type, expected_size
+        return urls, update, media_type, expected_size
 
     def extract_filename(self, _url) -> tuple:
         path = urlsplit(_url).path
@@ -283,21 +977,32 @@ class DownloadWorker(BaseDownloader):
                     hash_function):
             return True
 
+        verify_start = time.monotonic()
         try:
-            hash_value = hash_function(data).digest()
-            hash_value = base64.b64encode(hash_value).decode()
+            digest = hash_function(data).digest()
         except Exception as e:
             LOGGER.error(e)
             return False
-        if (hash_value != expected_hash) or (len(data) != expected_size):
+
+        valid = self.validate_digest(digest, len(data), expected_hash,
+                                     expected_size)
+        DOWNLOAD_VERIFY_SECONDS.observe(time.monotonic() - verify_start)
+        return valid
+
+    def validate_digest(self, digest, size, expected_hash,
+                        expected_size) -> bool:
+        hash_value = base64.b64encode(digest).decode()
+        if (hash_value != expected_hash) or (size != expected_size):
             return False
 
         return True
 
     def save_file(self, data, target, filename, filesize,
-                  download_start) -> None:
+                  download_start) -> bool:
         try:
+            write_start = time.monotonic()
             target.write_bytes(data)
+            DOWNLOAD_WRITE_SECONDS.observe(time.monotonic() - write_start)
             download_end = dt.now()
             download_time = download_end - download_start
             download_seconds = round(download_time.total_seconds(), 2)
@@ -306,3 +1011,5 @@ class DownloadWorker(BaseDownloader):
         except Exception as e:
             LOGGER.error(f"Error saving to disk: {target}")
             LOGGER.error(e)
+            return False
+        return True
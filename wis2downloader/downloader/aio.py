@@ -0,0 +1,140 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import aiohttp
+
+from wis2downloader import stop_event
+from wis2downloader.downloader import DownloadWorker
+from wis2downloader.log import LOGGER
+from wis2downloader.queue import BaseQueue
+
+
+class AsyncDownloadWorker(DownloadWorker):
+    """
+    Download worker that runs up to `concurrency` downloads at once on an
+    asyncio event loop, rather than one download per thread. Jobs are taken
+    from the same queue as DownloadWorker and go through the same download
+    coroutines, only the transport differs: requests are made with aiohttp
+    and blocking calls, such as writing to disk, run in the loop's default
+    executor. Up to `batch_size` jobs are taken from the queue at a time,
+    never more than there are free slots to start them. Other arguments
+    are as for DownloadWorker.
+    """
+    def __init__(self, queue: BaseQueue, concurrency: int = 100,
+                 batch_size: int = 10, **kwargs):
+        super().__init__(queue, **kwargs)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.active = 0
+        self.session = None
+
+    def start(self) -> None:
+        LOGGER.info(
+            f"Starting async download worker (concurrency {self.concurrency})")  # noqa
+        asyncio.run(self.run())
+
+    def create_session(self) -> aiohttp.ClientSession:
+        timeout = aiohttp.ClientTimeout(total=self.deadline,
+                                        sock_connect=self.connect_timeout,
+                                        sock_read=self.read_timeout)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        return aiohttp.ClientSession(timeout=timeout, connector=connector)
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.concurrency)
+        in_flight = set()
+
+        async with self.create_session() as session:
+            self.session = session
+            while not stop_event.is_set() and not self.abandoned:
+                # Wait for a free slot before taking jobs off the queue so
+                # that jobs stay available to other workers
+                await slots.acquire()
+                free = 1
+                while free < self.batch_size and not slots.locked():
+                    await slots.acquire()
+                    free += 1
+                # The queue blocks so dequeue from a thread
+                jobs = await loop.run_in_executor(
+                    None, self.queue.dequeue_many, free, 1)
+                for _ in range(free - len(jobs)):
+                    slots.release()
+
+                shutdown = False
+                for idx, job in enumerate(jobs):
+                    if job.shutdown:
+                        for _ in jobs[idx:]:
+                            slots.release()
+                        self.return_jobs(jobs[idx + 1:])
+                        shutdown = True
+                        break
+                    task = asyncio.create_task(self.run_job(job, slots))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+                if shutdown:
+                    break
+
+            # Let downloads already in progress finish
+            if in_flight:
+                await asyncio.gather(*in_flight, return_exceptions=True)
+
+        self.session = None
+
+    async def run_job(self, job, slots) -> None:
+        self.active += 1
+        if self.active == 1:
+            self.set_status("running")
+        delayed = False
+        try:
+            delayed = await self.aprocess_job(job)
+        except Exception as e:
+            LOGGER.error(e)
+        finally:
+            self.active -= 1
+            # With many jobs in flight the worker may never be idle, mark
+            # progress so the watchdog only sees a worker that is stuck
+            self.set_status("ready" if self.active == 0 else "running")
+            if not delayed:
+                self.queue.task_done(job)
+            slots.release()
+
+    def call(self, coro):
+        """Run a download coroutine from synchronous code, on an event loop
+        and session of its own. Not for use while the worker is running"""
+        async def main():
+            async with self.create_session() as session:
+                self.session = session
+                try:
+                    return await coro
+                finally:
+                    self.session = None
+
+        return asyncio.run(main())
+
+    async def run_blocking(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def wait_for(self, flight) -> bool:
+        """Wait for a download by another job without blocking the loop,
+        returning False if coalesce_timeout expires first"""
+        loop = asyncio.get_running_loop()
+        landed = loop.create_future()
+
+        def on_land(success):
+            loop.call_soon_threadsafe(
+                lambda: landed.done() or landed.set_result(success))
+
+        flight.add_done_callback(on_land)
+        try:
+            await asyncio.wait_for(landed, self.coalesce_timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    @asynccontextmanager
+    async def open_url(self, url):
+        async with self.session.get(url) as response:
+            yield (response.status, response.headers,
+                   response.content.iter_chunked(self.chunk_size))
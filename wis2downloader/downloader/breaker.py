@@ -0,0 +1,137 @@
+from collections import deque
+import enum
+import threading
+import time
+
+from wis2downloader.downloader.sources import get_host
+from wis2downloader.log import LOGGER
+from wis2downloader.metrics import CIRCUIT_BREAKER_STATE
+
+
+class CircuitState(enum.IntEnum):
+    closed = 0
+    half_open = 1
+    open = 2
+
+
+class HostCircuit:
+    __slots__ = ('state', 'outcomes', 'opened_at', 'probing', 'probed_at')
+
+    def __init__(self, window):
+        self.state = CircuitState.closed
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = 0.0
+        self.probing = False
+        self.probed_at = 0.0
+
+
+class CircuitBreaker:
+    """
+    Per host circuit breaker, shared between download workers.
+
+    A host's circuit opens when the failure rate over the last `window`
+    downloads reaches `failure_rate` (after at least `min_requests`). While
+    open no downloads are attempted from the host. After `reset_timeout`
+    seconds the circuit becomes half open and a single download is allowed
+    through: success closes the circuit, failure opens it again. A probe
+    whose outcome isn't recorded within `probe_timeout` seconds is given up
+    and another download let through.
+    """
+    def __init__(self, failure_rate: float = 0.5, window: int = 20,
+                 min_requests: int = 5, reset_timeout: float = 30,
+                 probe_timeout: float = 300):
+        self.failure_rate = failure_rate
+        self.window = window
+        self.min_requests = min_requests
+        self.reset_timeout = reset_timeout
+        self.probe_timeout = probe_timeout
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def _get(self, host) -> HostCircuit:
+        circuit = self._circuits.get(host)
+        if circuit is None:
+            circuit = HostCircuit(self.window)
+            self._circuits[host] = circuit
+            CIRCUIT_BREAKER_STATE.labels(host=host).set(circuit.state)
+        return circuit
+
+    def _set_state(self, host, circuit, state) -> None:
+        if circuit.state == state:
+            return
+        LOGGER.warning(f"Circuit for {host} is now {state.name}")
+        circuit.state = state
+        if state == CircuitState.open:
+            circuit.opened_at = time.monotonic()
+        if state != CircuitState.half_open:
+            circuit.probing = False
+        if state == CircuitState.closed:
+            circuit.outcomes.clear()
+        CIRCUIT_BREAKER_STATE.labels(host=host).set(state)
+
+    def _state(self, host, circuit) -> CircuitState:
+        if circuit.state == CircuitState.open and \
+                time.monotonic() - circuit.opened_at >= self.reset_timeout:
+            self._set_state(host, circuit, CircuitState.half_open)
+        return circuit.state
+
+    def state(self, url) -> CircuitState:
+        host = get_host(url)
+        with self._lock:
+            return self._state(host, self._get(host))
+
+    def is_available(self, url) -> bool:
+        """Whether downloads from the host of the url may be attempted, without
+        claiming the half open probe"""
+        return self.state(url) != CircuitState.open
+
+    def allow(self, url) -> bool:
+        """Whether a download from the host of the url should be attempted
+        now. In the half open state only one download is let through"""
+        host = get_host(url)
+        with self._lock:
+            circuit = self._get(host)
+            state = self._state(host, circuit)
+            if state == CircuitState.closed:
+                return True
+            if state != CircuitState.half_open:
+                return False
+            now = time.monotonic()
+            if circuit.probing and \
+                    now - circuit.probed_at < self.probe_timeout:
+                return False
+            circuit.probing = True
+            circuit.probed_at = now
+            return True
+
+    def retry_after(self, url) -> float:
+        """Seconds until the host of the url may be tried again"""
+        host = get_host(url)
+        with self._lock:
+            circuit = self._get(host)
+            if self._state(host, circuit) != CircuitState.open:
+                return 0.0
+            return max(0.0, self.reset_timeout -
+                       (time.monotonic() - circuit.opened_at))
+
+    def record_success(self, url) -> None:
+        host = get_host(url)
+        with self._lock:
+            circuit = self._get(host)
+            if circuit.state == CircuitState.half_open:
+                self._set_state(host, circuit, CircuitState.closed)
+            else:
+                circuit.outcomes.append(False)
+
+    def record_failure(self, url) -> None:
+        host = get_host(url)
+        with self._lock:
+            circuit = self._get(host)
+            if circuit.state == CircuitState.half_open:
+                self._set_state(host, circuit, CircuitState.open)
+                return
+            circuit.outcomes.append(True)
+            failures = sum(circuit.outcomes)
+            if len(circuit.outcomes) >= self.min_requests and \
+                    failures / len(circuit.outcomes) >= self.failure_rate:
+                self._set_state(host, circuit, CircuitState.open)
@@ -0,0 +1,112 @@
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from wis2downloader.log import LOGGER
+
+
+class DownloadIndex:
+    """
+    Index of data already downloaded, keyed by target, data_id and
+    integrity hash.
+
+    Lookups are answered from an in-memory dictionary. When a path is given
+    the index is also written to a SQLite database so that it survives
+    restarts. Entries expire after `retention` seconds.
+    """
+    def __init__(self, path: Optional[str] = None, retention: float = 86400,
+                 purge_interval: float = 600):
+        self.retention = retention
+        self.purge_interval = purge_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._db = None
+        self._last_purge = time.time()
+
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS downloads "
+                "(key TEXT PRIMARY KEY, expires REAL NOT NULL)")
+            self._db.commit()
+            self._load()
+
+    @staticmethod
+    def make_key(data_id, expected_hash=None,
+                 target=None) -> Optional[str]:
+        """Key of the data downloaded to a target, data saved to several
+        targets are indexed once for each"""
+        if data_id is None:
+            return None
+        key = data_id
+        if expected_hash is not None:
+            key = f"{key}:{expected_hash}"
+        if target is not None:
+            key = f"{target}:{key}"
+        return key
+
+    def _load(self) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute("DELETE FROM downloads WHERE expires < ?",
+                             (now,))
+            self._db.commit()
+            rows = self._db.execute("SELECT key, expires FROM downloads")
+            self._entries = dict(rows)
+        LOGGER.info(f"Loaded {len(self._entries)} entries into download index")  # noqa
+
+    def contains(self, key) -> bool:
+        """Return whether the key has been downloaded within the retention
+        period"""
+        if key is None:
+            return False
+        expires = self._entries.get(key)
+        return expires is not None and expires >= time.time()
+
+    def add(self, key) -> None:
+        """Record that the key has been downloaded"""
+        if key is None:
+            return
+        now = time.time()
+        expires = now + self.retention
+        with self._lock:
+            self._entries[key] = expires
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO downloads VALUES (?, ?)",
+                        (key, expires))
+                    self._db.commit()
+                except Exception as e:
+                    LOGGER.error("Error writing to download index")
+                    LOGGER.error(e)
+            if now - self._last_purge > self.purge_interval:
+                self._purge(now)
+
+    def _purge(self, now) -> None:
+        expired = [k for k, v in self._entries.items() if v < now]
+        for key in expired:
+            del self._entries[key]
+        if self._db is not None:
+            try:
+                self._db.execute("DELETE FROM downloads WHERE expires < ?",
+                                 (now,))
+                self._db.commit()
+            except Exception as e:
+                LOGGER.error("Error purging download index")
+                LOGGER.error(e)
+        self._last_purge = now
+
+    def size(self) -> int:
+        return len(self._entries)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,72 @@
+import threading
+
+
+class Flight:
+    """A download in progress that other jobs for the same data can wait on"""
+    def __init__(self):
+        self.success = False
+        self.followers = 0
+        # Other sources for the same data, offered by the waiting jobs
+        self.sources = []
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def add_sources(self, urls) -> None:
+        with self._lock:
+            self.sources.extend(urls)
+
+    def wait(self, timeout=None) -> bool:
+        """Block until the download completes, returning False if the
+        timeout expires first"""
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, fn) -> None:
+        """Call fn(success) once the download completes"""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self.success)
+
+    def land(self, success: bool) -> None:
+        with self._lock:
+            self.success = success
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(success)
+
+
+class InFlightRegistry:
+    """
+    Registry of downloads in progress, shared between download workers.
+
+    The first job to claim a key performs the download, subsequent jobs
+    for the same key are given the leader's flight to wait on.
+    """
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def claim(self, key) -> tuple:
+        """Returns the flight for the key and whether the caller is the
+        leader, responsible for the download"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = Flight()
+                self._flights[key] = flight
+                return flight, True
+            flight.followers += 1
+            return flight, False
+
+    def release(self, key, flight, success: bool) -> None:
+        """Called by the leader once the download has completed"""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.land(success)
+
+    def size(self) -> int:
+        return len(self._flights)
@@ -0,0 +1,46 @@
+import random
+
+
+# Status codes indicating the cache may be able to serve the data later
+RETRY_STATUS_CODES = (408, 425, 429, 500, 502, 503, 504)
+
+
+def parse_retry_after(value):
+    """Parse a Retry-After header given in seconds, dates are ignored"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with jitter for failed downloads.
+
+    The delay before attempt n (counting the first retry as 1) is drawn
+    uniformly between half and all of base_delay * 2 ** (n - 1), capped at
+    max_delay. Jobs are abandoned after max_attempts attempts in total.
+    """
+    def __init__(self, max_attempts: int = 5, base_delay: float = 5,
+                 max_delay: float = 600, status_codes=RETRY_STATUS_CODES):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.status_codes = set(status_codes)
+
+    def is_retryable_status(self, status) -> bool:
+        return status in self.status_codes
+
+    def should_retry(self, attempt) -> bool:
+        """Whether another attempt may be made after attempt (0 being the
+        first attempt) failed"""
+        return attempt + 1 < self.max_attempts
+
+    def delay(self, attempt, retry_after=None) -> float:
+        """Seconds to wait before retry number attempt, honouring the
+        Retry-After time requested by the server if longer"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        delay = random.uniform(delay / 2, delay)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
@@ -0,0 +1,99 @@
+import threading
+from urllib.parse import urlsplit
+
+
+def get_host(url) -> str:
+    return urlsplit(url).netloc
+
+
+class HostStats:
+    """Exponentially weighted moving averages for a single host"""
+    __slots__ = ('latency', 'throughput', 'failure_rate', 'samples')
+
+    def __init__(self):
+        self.latency = None
+        self.throughput = None
+        self.failure_rate = None
+        self.samples = 0
+
+
+class SourceStats:
+    """
+    Rolling latency, throughput and failure rate per host, updated from
+    completed downloads and used to rank equivalent sources for the same
+    data, fastest healthy host first.
+
+    Hosts with no history are ranked ahead of known hosts so that they get
+    tried and measured.
+    """
+    def __init__(self, alpha: float = 0.2, unhealthy_failure_rate: float = 0.5,
+                 min_throughput_bytes: int = 65536):
+        self.alpha = alpha
+        self.unhealthy_failure_rate = unhealthy_failure_rate
+        # Transfers smaller than this are dominated by latency and say little
+        # about the throughput of the host
+        self.min_throughput_bytes = min_throughput_bytes
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _ewma(self, previous, value):
+        if previous is None:
+            return value
+        return self.alpha * value + (1 - self.alpha) * previous
+
+    def _get(self, host) -> HostStats:
+        stats = self._hosts.get(host)
+        if stats is None:
+            stats = self._hosts.setdefault(host, HostStats())
+        return stats
+
+    def record_success(self, url, latency: float, nbytes: int,
+                       transfer_seconds: float) -> None:
+        with self._lock:
+            stats = self._get(get_host(url))
+            stats.latency = self._ewma(stats.latency, latency)
+            if nbytes >= self.min_throughput_bytes and transfer_seconds > 0:
+                stats.throughput = self._ewma(
+                    stats.throughput, nbytes / transfer_seconds)
+            stats.failure_rate = self._ewma(stats.failure_rate, 0.0)
+            stats.samples += 1
+
+    def record_failure(self, url) -> None:
+        with self._lock:
+            stats = self._get(get_host(url))
+            stats.failure_rate = self._ewma(stats.failure_rate, 1.0)
+            stats.samples += 1
+
+    def is_healthy(self, url) -> bool:
+        stats = self._hosts.get(get_host(url))
+        return stats is None or stats.failure_rate is None or \
+            stats.failure_rate < self.unhealthy_failure_rate
+
+    def estimate(self, url, size=None) -> float:
+        """Estimated time (seconds) to download size bytes from the host of
+        the url"""
+        stats = self._hosts.get(get_host(url))
+        if stats is None or stats.latency is None:
+            return 0.0
+        estimate = stats.latency
+        if size and stats.throughput:
+            estimate += size / stats.throughput
+        return estimate
+
+    def rank(self, urls, size=None) -> list:
+        """Order urls fastest healthy host first, keeping the original order
+        where hosts are equivalent"""
+        return sorted(urls, key=lambda url: (not self.is_healthy(url),
+                                             self.estimate(url, size)))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                host: {
+                    'latency': stats.latency,
+                    'throughput': stats.throughput,
+                    'failure_rate': stats.failure_rate,
+                    'samples': stats.samples
+                }
+                for host, stats in self._hosts.items()
+            }
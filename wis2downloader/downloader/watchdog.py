@@ -0,0 +1,62 @@
+import threading
+import time
+from typing import Callable
+
+from wis2downloader import stop_event
+from wis2downloader.downloader import BaseDownloader
+from wis2downloader.log import LOGGER
+from wis2downloader.metrics import STUCK_WORKERS
+
+
+class WorkerWatchdog:
+    """
+    Watches the download workers for any that have been in the "running"
+    state for longer than `timeout` seconds. A stuck worker is abandoned:
+    the downloads it leads are counted as failed and released, it stops
+    once its current job returns and a new worker created by `factory` is
+    started in its place.
+
+    `workers` and `threads` are the lists of workers and their threads,
+    updated in place as workers are replaced.
+    """
+    def __init__(self, workers: list, threads: list,
+                 factory: Callable[[], BaseDownloader],
+                 timeout: float = 3600, period: float = 30):
+        self.workers = workers
+        self.threads = threads
+        self.factory = factory
+        self.timeout = timeout
+        self.period = period
+
+    def check(self) -> int:
+        """Replace any stuck workers, returning the number replaced"""
+        now = time.monotonic()
+        replaced = 0
+        for idx, worker in enumerate(list(self.workers)):
+            if worker.status != "running":
+                continue
+            stuck_for = now - worker.status_since
+            if stuck_for < self.timeout:
+                continue
+
+            LOGGER.error(f"Download worker {idx} stuck for {stuck_for:.0f} seconds, replacing")  # noqa
+            STUCK_WORKERS.inc(1)
+            worker.abandon()
+
+            replacement = self.factory()
+            thread = threading.Thread(target=replacement.start, daemon=True)
+            self.workers[idx] = replacement
+            self.threads[idx] = thread
+            thread.start()
+            replaced += 1
+
+        return replaced
+
+    def start(self) -> None:
+        LOGGER.info("Starting download worker watchdog")
+        while not stop_event.is_set():
+            try:
+                self.check()
+            except Exception as e:
+                LOGGER.error(e)
+            stop_event.wait(self.period)
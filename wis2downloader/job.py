@@ -0,0 +1,100 @@
+def _length(value):
+    """Length given in a notification as an int, None if missing or
+    invalid. Some publishers give lengths as strings"""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        length = int(value)
+    except (TypeError, ValueError):
+        return None
+    return length if length >= 0 else None
+
+
+class Job:
+    """
+    A download job, holding only the parts of a WIS2 notification needed to
+    download and verify the data. The full notification is only kept if
+    requested, as `payload`.
+
+    Links are held as (rel, href, type, length) tuples, keeping only the
+    canonical and update links, with the length as an int or None. Data
+    embedded in the notification are held as an (encoding, value, size)
+    tuple.
+
+    `pubtime` is the publication time given in the notification and
+    `queued_at` the time (seconds since the epoch) the job was queued, to
+    measure latencies.
+    """
+    __slots__ = ('topic', 'target', 'data_id', 'hash_method', 'hash_value',
+                 'links', 'content', 'attempt', 'payload', 'shutdown',
+                 'pubtime', 'queued_at')
+
+    def __init__(self, topic: str = None, target: str = ".",
+                 data_id: str = None, hash_method: str = None,
+                 hash_value: str = None, links: tuple = (),
+                 content: tuple = None, attempt: int = 0,
+                 payload: dict = None, shutdown: bool = False,
+                 pubtime: str = None, queued_at: float = None):
+        self.topic = topic
+        self.target = target
+        self.data_id = data_id
+        self.hash_method = hash_method
+        self.hash_value = hash_value
+        self.links = links
+        self.content = content
+        # Number of failed attempts to download the data
+        self.attempt = attempt
+        self.payload = payload
+        # Signals the worker receiving the job to stop
+        self.shutdown = shutdown
+        self.pubtime = pubtime
+        self.queued_at = queued_at
+
+    @classmethod
+    def from_notification(cls, topic: str, notification: dict,
+                          target: str = ".", keep_payload: bool = False):
+        properties = notification.get('properties', {})
+        integrity = properties.get('integrity') or {}
+        links = tuple(
+            (link.get('rel'), link.get('href'), link.get('type'),
+             _length(link.get('length')))
+            for link in notification.get('links', [])
+            if link.get('rel') in ('canonical', 'update')
+        )
+        content = properties.get('content')
+        if isinstance(content, dict) and content.get('value') is not None:
+            content = (content.get('encoding'), content['value'],
+                       _length(content.get('size')))
+        else:
+            content = None
+        return cls(topic=topic, target=target,
+                   data_id=properties.get('data_id'),
+                   hash_method=integrity.get('method'),
+                   hash_value=integrity.get('value'),
+                   links=links, content=content,
+                   payload=notification if keep_payload else None,
+                   pubtime=properties.get('pubtime'))
+
+    def to_dict(self) -> dict:
+        """Plain representation of the job, e.g. to be stored as JSON"""
+        result = {name: getattr(self, name) for name in self.__slots__}
+        result['links'] = [list(link) for link in self.links]
+        if self.content is not None:
+            result['content'] = list(self.content)
+        return result
+
+    @classmethod
+    def from_dict(cls, value: dict):
+        value = dict(value)
+        value['links'] = tuple(tuple(link) for link in value.get('links', ()))
+        if value.get('content') is not None:
+            value['content'] = tuple(value['content'])
+        return cls(**value)
+
+    def __eq__(self, other):
+        if not isinstance(other, Job):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"Job(topic={self.topic!r}, data_id={self.data_id!r})"
@@ -1,8 +1,19 @@
-from prometheus_client import Counter, Gauge
+from prometheus_client import Counter, Gauge, Histogram
 
 
 QUEUE_SIZE = Gauge(
     'queue_size', 'Current size of the job queue')
+QUEUE_OVERFLOW_SIZE = Gauge(
+    'queue_size_overflow',
+    'Jobs spilled to disk as the job queue was above its high watermark')
+QUEUE_LAG = Gauge(
+    'queue_size_lag',
+    'Jobs in the shared job queue not yet delivered to a consumer of the group',  # noqa
+    ['group'])
+QUEUE_CONSUMER_PENDING = Gauge(
+    'queue_size_consumer_pending',
+    'Jobs delivered to a consumer of the shared job queue and not yet completed',  # noqa
+    ['consumer'])
 DOWNLOADED_BYTES = Counter(
     'downloaded_bytes', 'Total number of downloaded bytes',
     ['topic', 'centre_id', 'file_type'])
@@ -12,6 +23,71 @@ DOWNLOADED_FILES = Counter(
 FAILED_DOWNLOADS = Counter(
     'failed_downloads', 'Total number of failed downloads',
     ['topic', 'centre_id'])
+DEDUP_LOOKUPS = Counter(
+    'notification_dedup_lookups',
+    'Total number of notifications checked against those already received')
+DEDUP_HITS = Counter(
+    'notification_dedup_hits',
+    'Total number of duplicate notifications skipped before being queued')
+FILTERED_NOTIFICATIONS = Counter(
+    'filtered_notifications',
+    'Total number of notifications not downloaded as rejected by the subscription filters',  # noqa
+    ['topic'])
 TOPIC_STATUS = Gauge(
     'topic_subscription_status', 'Subscription status of a given topic',
     ['topic'])
+INLINE_DOWNLOADS = Counter(
+    'inline_downloads',
+    'Total number of files saved from content embedded in the notification, without downloading',  # noqa
+    ['topic', 'centre_id'])
+COALESCED_DOWNLOADS = Counter(
+    'coalesced_downloads',
+    'Total number of downloads skipped as the same data were already being downloaded',  # noqa
+    ['topic', 'centre_id'])
+CIRCUIT_BREAKER_STATE = Gauge(
+    'circuit_breaker_state',
+    'Circuit breaker state of a download host (0 closed, 1 half-open, 2 open)',  # noqa
+    ['host'])
+RETRIES_SCHEDULED = Counter(
+    'download_retries_scheduled', 'Total number of download retries scheduled',  # noqa
+    ['topic', 'centre_id'])
+RETRIES_SUCCEEDED = Counter(
+    'download_retries_succeeded',
+    'Total number of downloads that succeeded after being retried',
+    ['topic', 'centre_id'])
+RETRIES_ABANDONED = Counter(
+    'download_retries_abandoned',
+    'Total number of downloads abandoned after the maximum number of attempts',  # noqa
+    ['topic', 'centre_id'])
+STUCK_WORKERS = Counter(
+    'stuck_download_workers',
+    'Total number of download workers replaced by the watchdog after getting stuck')  # noqa
+STARTUP_SECONDS = Gauge(
+    'startup_phase_seconds',
+    'Time taken by each phase of the startup of the downloader',
+    ['phase'])
+QUEUE_WAIT_SECONDS = Histogram(
+    'queue_wait_seconds',
+    'Time jobs wait in the job queue before being processed',
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600))
+DOWNLOAD_TTFB_SECONDS = Histogram(
+    'download_ttfb_seconds',
+    'Time from sending the request to receiving the response headers for successful downloads',  # noqa
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+DOWNLOAD_TRANSFER_SECONDS = Histogram(
+    'download_transfer_seconds',
+    'Time taken to receive the response body of successful downloads',
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800))
+DOWNLOAD_VERIFY_SECONDS = Histogram(
+    'download_verify_seconds',
+    'Time taken to check the integrity of downloaded data',
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+DOWNLOAD_WRITE_SECONDS = Histogram(
+    'download_write_seconds',
+    'Time taken to write downloaded data to their target',
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+NOTIFICATION_TO_DISK_SECONDS = Histogram(
+    'notification_to_disk_seconds',
+    'Time from the publication of notifications (pubtime) to the data being saved',  # noqa
+    ['centre_id'],
+    buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 21600))
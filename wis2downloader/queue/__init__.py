@@ -1,10 +1,26 @@
 from abc import ABC, abstractmethod
-from queue import Queue
+from collections import deque
+import heapq
+import itertools
+import json
+import os
+from pathlib import Path
+import shutil
+import socket
+import sqlite3
+import threading
 import time
 
+try:
+    import redis
+except ImportError:
+    redis = None
+
 from wis2downloader import stop_event
+from wis2downloader.job import Job
 from wis2downloader.log import LOGGER
-from wis2downloader.metrics import QUEUE_SIZE
+from wis2downloader.metrics import (QUEUE_CONSUMER_PENDING, QUEUE_LAG,
+                                    QUEUE_OVERFLOW_SIZE, QUEUE_SIZE)
 
 
 class BaseQueue(ABC):
@@ -14,19 +30,32 @@ class BaseQueue(ABC):
         """Add an item to the queue"""
         pass
 
+    @abstractmethod
+    def enqueue_many(self, items):
+        """Add several items to the queue"""
+        pass
+
     @abstractmethod
     def dequeue(self):
         """Remove and return an item from the queue"""
         pass
 
+    @abstractmethod
+    def dequeue_many(self, max_items: int, timeout: float = None) -> list:
+        """Remove and return up to max_items items from the queue, waiting
+        up to timeout seconds (indefinitely if None) for at least one.
+        Returns an empty list if the timeout expires"""
+        pass
+
     @abstractmethod
     def size(self) -> int:
         """Return the number of items in the queue"""
         pass
 
     @abstractmethod
-    def task_done(self):
-        """Indicate that a formerly enqueued task is complete"""
+    def task_done(self, item=None):
+        """Indicate that a formerly enqueued task is complete. Queues that
+        acknowledge items individually need the item returned by dequeue"""
         pass
 
     @abstractmethod
@@ -46,6 +75,11 @@ class BaseQueue(ABC):
         """
         pass
 
+    def is_saturated(self) -> bool:
+        """Whether producers should slow down as the queue is above its
+        high watermark"""
+        return False
+
 
 class QMonitor:
     def __init__(self, _queue: BaseQueue, period: int = 60):
@@ -55,28 +89,330 @@ class QMonitor:
 
 
 class SimpleQueue(BaseQueue):
-    def __init__(self):
-        self._queue = Queue()
+    """
+    In memory queue, optionally bounded.
+
+    If `max_size` is set, items enqueued once the queue holds `max_size`
+    items are spilled to an overflow file at `overflow_path` and the queue
+    reports itself as saturated. Spilled items are read back into memory,
+    in the order they were enqueued, once the queue drains to
+    `low_watermark` items.
+    """
+    def __init__(self, max_size: int = None, low_watermark: int = None,
+                 overflow_path: str = None):
+        self._items = deque()
+        self._not_empty = threading.Condition()
         self.active = True
+        self.max_size = max_size
+        if max_size and low_watermark is None:
+            low_watermark = max_size // 2
+        self.low_watermark = low_watermark
+        self._overflow = None
+        if max_size:
+            self._overflow = OverflowFile(
+                overflow_path or 'queue-overflow.jsonl')
+        self._spilling = False
+        # Queue size for the metric, computed when scraped
+        QUEUE_SIZE.set_function(self.size)
 
     def enqueue(self, item):
-        self._queue.put(item)
-        # Note queue size for the metric
-        QUEUE_SIZE.set(self.size())
+        self.enqueue_many([item])
+
+    def enqueue_many(self, items):
+        with self._not_empty:
+            for item in items:
+                if self._overflow is not None and (
+                        self._spilling or len(self._items) >= self.max_size):
+                    if not self._spilling:
+                        LOGGER.warning(f"Job queue above {self.max_size} jobs, spilling to disk")  # noqa
+                    self._spilling = True
+                    self._overflow.write(item)
+                else:
+                    self._items.append(item)
+            self._not_empty.notify(len(items))
 
     def dequeue(self):
-        # Note queue size for the metric
-        QUEUE_SIZE.set(self.size())
-        return self._queue.get()
+        return self.dequeue_many(1)[0]
+
+    def dequeue_many(self, max_items: int, timeout: float = None) -> list:
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: self._items, timeout):
+                return []
+            count = min(max_items, len(self._items))
+            items = [self._items.popleft() for _ in range(count)]
+            if self._spilling and len(self._items) <= self.low_watermark:
+                self._refill()
+        return items
+
+    def _refill(self):
+        """Move spilled items back into memory, up to the high watermark.
+        Called with the lock held"""
+        space = self.max_size - len(self._items)
+        if space <= 0:
+            return
+        items = self._overflow.read(space)
+        self._items.extend(items)
+        self._not_empty.notify(len(items))
+        if self._overflow.size() == 0:
+            LOGGER.info("Job queue overflow drained")
+            self._overflow.reset()
+            self._spilling = False
+
+    def is_saturated(self) -> bool:
+        return self._spilling
 
     def size(self) -> int:
-        return self._queue.qsize()
+        if self._overflow is not None:
+            return len(self._items) + self._overflow.size()
+        return len(self._items)
+
+    def task_done(self, item=None):
+        pass
+
+    def is_empty(self) -> bool:
+        return self.size() == 0
+
+    def toggle_active(self):
+        self.active = not self.active
+
+    def is_active(self):
+        return self.active
+
+
+class OverflowFile:
+    """
+    Append only file of JSON encoded items, read back in order.
+
+    Once at least `compact_size` bytes have been read, and they make up at
+    least half of the file, the items read are dropped from the start of
+    the file so that it doesn't grow without limit under a sustained
+    backlog.
+    """
+    def __init__(self, path: str, compact_size: int = 16777216):
+        self.path = path
+        self.compact_size = compact_size
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # Items in memory are not persisted, so neither are those spilled
+        self._file = open(path, 'w+b')
+        self._read_pos = 0
+        self._end = 0
+        self._count = 0
+        self._at_end = True
+        QUEUE_OVERFLOW_SIZE.set_function(self.size)
+
+    def write(self, item) -> None:
+        if not self._at_end:
+            self._file.seek(0, os.SEEK_END)
+            self._at_end = True
+        line = json.dumps(item.to_dict()).encode('utf-8') + b'\n'
+        self._file.write(line)
+        self._end += len(line)
+        self._count += 1
+
+    def read(self, max_items: int) -> list:
+        items = []
+        self._file.seek(self._read_pos)
+        self._at_end = False
+        while len(items) < max_items and self._count > 0:
+            line = self._file.readline()
+            if not line:
+                break
+            items.append(Job.from_dict(json.loads(line)))
+            self._count -= 1
+        self._read_pos = self._file.tell()
+        if self._read_pos >= self.compact_size and \
+                self._read_pos >= self._end - self._read_pos:
+            self._compact()
+        return items
+
+    def _compact(self) -> None:
+        """Rewrite the file without the items already read"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as tmp:
+            self._file.seek(self._read_pos)
+            shutil.copyfileobj(self._file, tmp)
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'r+b')
+        self._end -= self._read_pos
+        self._read_pos = 0
+        self._at_end = False
+
+    def size(self) -> int:
+        return self._count
+
+    def reset(self) -> None:
+        """Truncate the file once all items have been read"""
+        self._file.seek(0)
+        self._file.truncate()
+        self._read_pos = 0
+        self._end = 0
+        self._at_end = True
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class InProgress:
+    """
+    Items dequeued but not yet acknowledged, mapping each item handed out
+    to the reference (row or message id) needed to acknowledge it
+    """
+    def __init__(self):
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def add(self, item, ref) -> None:
+        with self._lock:
+            self._items.setdefault(id(item), deque()).append(ref)
+
+    def pop(self, item=None):
+        """Returns the reference for the item, or for the oldest item in
+        progress if no item is given. None if there is nothing to
+        acknowledge"""
+        with self._lock:
+            if not self._items:
+                return None
+            key = next(iter(self._items)) if item is None else id(item)
+            refs = self._items.get(key)
+            if not refs:
+                return None
+            ref = refs.popleft()
+            if not refs:
+                del self._items[key]
+            return ref
+
+    def size(self) -> int:
+        with self._lock:
+            return sum(len(refs) for refs in self._items.values())
+
+
+class PersistentQueue(BaseQueue):
+    """
+    Queue persisted to a SQLite database so that jobs survive a restart or
+    crash.
+
+    Items are acknowledged, and removed from the database, by task_done. Any
+    items dequeued but not acknowledged when the process stopped are
+    returned to the queue on start up. To sustain high enqueue rates writes
+    are committed in batches of `batch_size`, or after `commit_interval`
+    seconds.
+
+    Control items, such as the shutdown signal, are held in memory only.
+    """
+    def __init__(self, path: str, batch_size: int = 100,
+                 commit_interval: float = 0.5):
+        self.path = path
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.active = True
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY "
+            "AUTOINCREMENT, state INTEGER NOT NULL DEFAULT 0, item TEXT)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+        # Recover items in progress when the process last stopped
+        recovered = self._db.execute(
+            "UPDATE jobs SET state = 0 WHERE state = 1").rowcount
+        self._db.commit()
+        if recovered > 0:
+            LOGGER.warning(f"Recovered {recovered} unfinished jobs from {path}")  # noqa
+
+        self._pending = self._db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = 0").fetchone()[0]
+        self._control = deque()
+        self._in_progress = InProgress()
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+        self._not_empty = threading.Condition()
+        # Queue size for the metric, computed when scraped
+        QUEUE_SIZE.set_function(self.size)
+
+    def _commit(self) -> None:
+        if self._uncommitted > 0:
+            self._db.commit()
+            self._uncommitted = 0
+        self._last_commit = time.monotonic()
 
-    def task_done(self):
-        self._queue.task_done()
+    def _write(self, sql, params, many=False):
+        if many:
+            cursor = self._db.executemany(sql, params)
+        else:
+            cursor = self._db.execute(sql, params)
+        self._uncommitted += len(params) if many else 1
+        if self._uncommitted >= self.batch_size or \
+                time.monotonic() - self._last_commit > self.commit_interval:
+            self._commit()
+        return cursor
+
+    def enqueue(self, item):
+        self.enqueue_many([item])
+
+    def enqueue_many(self, items):
+        rows = []
+        with self._not_empty:
+            for item in items:
+                if item.shutdown:
+                    self._control.append(item)
+                else:
+                    rows.append((json.dumps(item.to_dict()),))
+            if rows:
+                self._write("INSERT INTO jobs (item) VALUES (?)", rows,
+                            many=True)
+                self._pending += len(rows)
+            self._not_empty.notify(len(items))
+
+    def dequeue(self):
+        return self.dequeue_many(1)[0]
+
+    def dequeue_many(self, max_items: int, timeout: float = None) -> list:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._not_empty:
+            while True:
+                if self._control:
+                    return [self._control.popleft()]
+                rows = self._db.execute(
+                    "SELECT id, item FROM jobs WHERE state = 0 "
+                    "ORDER BY id LIMIT ?", (max_items,)).fetchall()
+                if rows:
+                    break
+                # Nothing to do, flush any outstanding writes while waiting
+                self._commit()
+                wait = self.commit_interval
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        return []
+                self._not_empty.wait(wait)
+
+            self._write("UPDATE jobs SET state = 1 WHERE id = ?",
+                        [(rowid,) for rowid, _ in rows], many=True)
+            self._pending -= len(rows)
+            items = []
+            for rowid, data in rows:
+                item = Job.from_dict(json.loads(data))
+                self._in_progress.add(item, rowid)
+                items.append(item)
+
+        return items
+
+    def task_done(self, item=None):
+        rowid = self._in_progress.pop(item)
+        if rowid is None:
+            return
+        with self._not_empty:
+            self._write("DELETE FROM jobs WHERE id = ?", (rowid,))
+
+    def size(self) -> int:
+        return self._pending + len(self._control)
 
     def is_empty(self) -> bool:
-        return self._queue.empty()
+        return self.size() == 0
 
     def toggle_active(self):
         self.active = not self.active
@@ -84,6 +420,250 @@ class SimpleQueue(BaseQueue):
     def is_active(self):
         return self.active
 
+    def close(self) -> None:
+        with self._not_empty:
+            self._commit()
+            self._db.close()
+
+
+class DelayQueue:
+    """
+    Holds items until they are due and then adds them to a queue, e.g. for
+    jobs that cannot be processed now but should be tried again later.
+
+    Items taken from the queue are only acknowledged once they have been
+    added back to it, so a persistent queue still holds them if the process
+    stops while they wait here.
+    """
+    def __init__(self, _queue: BaseQueue):
+        self.queue = _queue
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+    def schedule(self, item, delay: float) -> None:
+        """Add item to the queue after delay seconds"""
+        due = time.monotonic() + delay
+        with self._condition:
+            heapq.heappush(self._heap, (due, next(self._counter), item))
+            self._condition.notify()
+
+    def size(self) -> int:
+        return len(self._heap)
+
+    def pop_due(self, timeout: float = 1.0) -> list:
+        """Wait up to timeout seconds for items to become due and return
+        them"""
+        with self._condition:
+            if self._heap:
+                wait = self._heap[0][0] - time.monotonic()
+            else:
+                wait = timeout
+            if wait > 0:
+                self._condition.wait(min(wait, timeout))
+
+            due = []
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap)[2])
+            return due
+
+    def release_due(self, timeout: float = 1.0) -> int:
+        """Wait up to timeout seconds for items to become due and add them
+        back to the queue, returning the number added"""
+        items = self.pop_due(timeout)
+        for item in items:
+            if isinstance(item, Job):
+                # Time spent waiting here is not queue wait time
+                item.queued_at = time.time()
+            self.queue.enqueue(item)
+            self.queue.task_done(item)
+        return len(items)
+
+    def start(self) -> None:
+        LOGGER.info("Starting delay queue")
+        while not stop_event.is_set():
+            self.release_due()
+
 
 class RedisQueue(BaseQueue):
-    pass
+    """
+    Queue held in a Redis stream, shared by download workers on several
+    hosts through a consumer group.
+
+    Each item is delivered to a single consumer and acknowledged, and
+    removed from the stream, by task_done. Items not acknowledged within
+    `visibility_timeout` seconds, for example as the consumer died, are
+    reclaimed and delivered to another consumer. The visibility timeout
+    should therefore be longer than the download deadline.
+
+    Control items, such as the shutdown signal, are local to this node and
+    not sent to the stream.
+
+    The size of the queue and its metrics are read from Redis at most once
+    every `stats_interval` seconds. Requires Redis 6.2 or later.
+    """
+    def __init__(self, url: str = 'redis://localhost:6379/0',
+                 stream: str = 'wis2downloader:jobs',
+                 group: str = 'wis2downloader', consumer: str = None,
+                 visibility_timeout: float = 3600, block: float = 1.0,
+                 stats_interval: float = 1.0, client=None):
+        if client is None:
+            if redis is None:
+                raise RuntimeError("The redis queue requires the redis package, install with pip install wis2downloader[redis]")  # noqa
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.visibility_timeout = visibility_timeout
+        self.block = block
+        self.stats_interval = stats_interval
+        self.active = True
+
+        try:
+            self.client.xgroup_create(stream, group, id='0', mkstream=True)
+        except Exception as e:
+            # The group may already have been created by another node
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+        self._control = deque()
+        self._in_progress = InProgress()
+        self._last_reclaim = 0.0
+        self._last_stats = None
+        self._lag = 0
+        # Queue size for the metric, computed when scraped
+        QUEUE_SIZE.set_function(self.size)
+
+    def _reclaim(self, count):
+        """Claim items left unacknowledged by other consumers"""
+        now = time.monotonic()
+        if now - self._last_reclaim < min(self.visibility_timeout / 2, 60):
+            return []
+        self._last_reclaim = now
+        result = self.client.xautoclaim(
+            self.stream, self.group, self.consumer,
+            min_idle_time=int(self.visibility_timeout * 1000),
+            start_id='0-0', count=count)
+        messages = result[1]
+        if not messages:
+            return []
+        # Keep claiming while there is a backlog of abandoned items
+        self._last_reclaim = 0.0
+        LOGGER.warning(f"Reclaimed {len(messages)} jobs from an unresponsive consumer")  # noqa
+        return messages
+
+    def _update_stats(self):
+        """Read the group's lag and the consumers' pending items from
+        Redis, unless they were read within stats_interval seconds"""
+        now = time.monotonic()
+        if self._last_stats is not None and \
+                now - self._last_stats < self.stats_interval:
+            return
+        self._last_stats = now
+        try:
+            for group in self.client.xinfo_groups(self.stream):
+                name = group['name']
+                if isinstance(name, bytes):
+                    name = name.decode()
+                if name != self.group:
+                    continue
+                lag = group.get('lag')
+                if lag is None:
+                    # Not reported before Redis 7. Acknowledged items are
+                    # deleted, so the remainder of the stream is pending or
+                    # waiting for delivery
+                    lag = self.client.xlen(self.stream) - group['pending']
+                self._lag = lag
+                QUEUE_LAG.labels(group=self.group).set(lag)
+            for consumer in self.client.xinfo_consumers(self.stream,
+                                                        self.group):
+                name = consumer['name']
+                if isinstance(name, bytes):
+                    name = name.decode()
+                QUEUE_CONSUMER_PENDING.labels(consumer=name).set(
+                    consumer['pending'])
+        except Exception as e:
+            LOGGER.error(f"Failed to update queue metrics: {e}")
+
+    def enqueue(self, item):
+        self.enqueue_many([item])
+
+    def enqueue_many(self, items):
+        pipe = self.client.pipeline(transaction=False)
+        for item in items:
+            if item.shutdown:
+                self._control.append(item)
+            else:
+                pipe.xadd(self.stream, {'item': json.dumps(item.to_dict())})
+        pipe.execute()
+
+    def dequeue(self):
+        return self.dequeue_many(1)[0]
+
+    def dequeue_many(self, max_items: int, timeout: float = None) -> list:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._control:
+                return [self._control.popleft()]
+            messages = self._reclaim(max_items)
+            if not messages:
+                block = self.block
+                if deadline is not None:
+                    block = min(block, deadline - time.monotonic())
+                    if block <= 0:
+                        return []
+                result = self.client.xreadgroup(
+                    self.group, self.consumer, {self.stream: '>'},
+                    count=max_items, block=max(1, int(block * 1000)))
+                if result:
+                    messages = result[0][1]
+            items = self._load(messages)
+            if items:
+                return items
+
+    def _load(self, messages) -> list:
+        """Decode the messages read from the stream into items in
+        progress"""
+        items = []
+        deleted = []
+        for message_id, fields in messages:
+            data = None
+            if fields:
+                data = fields.get(b'item', fields.get('item'))
+            if data is None:
+                # A reclaimed entry that has since been deleted from the
+                # stream, which Redis 6.2 keeps returning until acknowledged
+                if message_id is not None:
+                    deleted.append(message_id)
+                continue
+            item = Job.from_dict(json.loads(data))
+            self._in_progress.add(item, message_id)
+            items.append(item)
+        if deleted:
+            self.client.xack(self.stream, self.group, *deleted)
+        return items
+
+    def task_done(self, item=None):
+        message_id = self._in_progress.pop(item)
+        if message_id is None:
+            return
+        pipe = self.client.pipeline()
+        pipe.xack(self.stream, self.group, message_id)
+        pipe.xdel(self.stream, message_id)
+        pipe.execute()
+
+    def size(self) -> int:
+        """Number of items in the stream not yet delivered to a consumer"""
+        self._update_stats()
+        return self._lag + len(self._control)
+
+    def is_empty(self) -> bool:
+        return self.size() == 0
+
+    def toggle_active(self):
+        self.active = not self.active
+
+    def is_active(self):
+        return self.active
@@ -0,0 +1,418 @@
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+from typing import Optional
+from urllib.parse import unquote
+from uuid import uuid4
+
+from wis2downloader import stop_event
+from wis2downloader.downloader import DownloadWorker
+from wis2downloader.downloader.breaker import CircuitBreaker
+from wis2downloader.downloader.index import DownloadIndex
+from wis2downloader.downloader.inflight import InFlightRegistry
+from wis2downloader.downloader.retry import RetryPolicy
+from wis2downloader.downloader.sources import SourceStats
+from wis2downloader.downloader.watchdog import WorkerWatchdog
+from wis2downloader.job import Job
+from wis2downloader.log import LOGGER, setup_logger
+from wis2downloader.metrics import STARTUP_SECONDS
+from wis2downloader.queue import (DelayQueue, PersistentQueue, RedisQueue,
+                                  SimpleQueue)
+from wis2downloader.subscriber.filters import ContentFilter
+from wis2downloader.subscriber.manager import SubscriberManager
+from wis2downloader.utils.validate_target import validate_target
+from wis2downloader.utils.validate_topic import (TOPIC_VALIDATOR,
+                                                 validate_topic)
+from wis2downloader.utils.config import load_config
+
+
+class Runtime:
+    """
+    The background part of the downloader: the job queue, download workers
+    and MQTT subscriber, shared by the requests served by the Flask app.
+    Nothing is started until start() is called, use get_runtime() for the
+    runtime of the process.
+    """
+    def __init__(self, config: Optional[dict] = None):
+        self.config = load_config() if config is None else config
+        self.started = False
+        self.stopped = False
+        self._lock = threading.Lock()
+        # Guards session_info and the session file, changed by concurrent
+        # requests
+        self._session_lock = threading.RLock()
+
+    def start(self) -> None:
+        """Start the workers and subscriber and restore the subscriptions,
+        doing nothing if already started"""
+        with self._lock:
+            if self.started:
+                return
+            self._start()
+            self.started = True
+
+    def _phase(self, name: str, func) -> None:
+        """Run a phase of the startup, recording the time it takes"""
+        started = time.monotonic()
+        func()
+        elapsed = time.monotonic() - started
+        STARTUP_SECONDS.labels(phase=name).set(elapsed)
+        LOGGER.info(f"Startup phase {name} took {elapsed:.3f}s")
+
+    def _start(self) -> None:
+        """
+        Start the components, those independent of each other in parallel:
+        the workers are started while the subscriber is created and the
+        topic hierarchy loaded, the subscriptions are then restored. The
+        brokers are connected to in the background by the subscriber.
+        """
+        started = time.monotonic()
+        CONFIG = self.config
+
+        setup_logger(loglevel=CONFIG['log_level'],
+                     save=CONFIG['save_logs'],
+                     log_path=CONFIG['log_path'])
+
+        self._phase('queue', self._create_queue)
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            workers = executor.submit(self._phase, 'workers',
+                                      self._start_workers)
+            subscriber = executor.submit(self._phase, 'subscriber',
+                                         self._start_subscriber)
+            topics = executor.submit(self._phase, 'topic_hierarchy',
+                                     self._load_topic_hierarchy)
+            subscriber.result()
+            topics.result()
+            self._phase('restore_subscriptions',
+                        self._restore_subscriptions)
+            workers.result()
+
+        STARTUP_SECONDS.labels(phase='total').set(time.monotonic() - started)
+
+    def _create_queue(self) -> None:
+        CONFIG = self.config
+
+        # Create the queue
+        queue_backend = CONFIG.get('queue_backend', 'memory')
+        if queue_backend == 'redis':
+            self.queue = RedisQueue(
+                CONFIG.get('queue_url', 'redis://localhost:6379/0'),
+                stream=CONFIG.get('queue_stream', 'wis2downloader:jobs'),
+                group=CONFIG.get('queue_group', 'wis2downloader'),
+                visibility_timeout=CONFIG.get('queue_visibility_timeout', 3600))  # noqa
+        elif queue_backend == 'sqlite':
+            self.queue = PersistentQueue(
+                CONFIG.get('queue_path', 'job-queue.db'),
+                batch_size=CONFIG.get('queue_batch_size', 100),
+                commit_interval=CONFIG.get('queue_commit_interval', 0.5))
+        else:
+            self.queue = SimpleQueue(
+                max_size=CONFIG.get('queue_max_size'),
+                low_watermark=CONFIG.get('queue_low_watermark'),
+                overflow_path=CONFIG.get('queue_overflow_path'))
+
+        # Index of downloaded data, shared by the workers to skip duplicates
+        self.download_index = DownloadIndex(
+            CONFIG.get('download_index'),
+            CONFIG.get('download_index_retention_hours', 24) * 3600)
+
+    def _start_workers(self) -> None:
+        CONFIG = self.config
+
+        # Downloads in progress, so that the same data announced by several
+        # global caches are only downloaded once
+        in_flight = InFlightRegistry()
+
+        # Rolling latency and throughput of the hosts data are downloaded
+        # from, used to prefer the fastest source when several are known
+        source_stats = SourceStats(CONFIG.get('source_stats_alpha', 0.2))
+
+        # Stop trying hosts that are failing, jobs for them are deferred
+        # using the delay queue until the host may be tried again
+        breaker = CircuitBreaker(
+            CONFIG.get('circuit_breaker_failure_rate', 0.5),
+            CONFIG.get('circuit_breaker_window', 20),
+            CONFIG.get('circuit_breaker_min_requests', 5),
+            CONFIG.get('circuit_breaker_reset_timeout', 30),
+            CONFIG.get('circuit_breaker_probe_timeout', 300))
+        delay_queue = DelayQueue(self.queue)
+        delay_thread = threading.Thread(target=delay_queue.start,
+                                        daemon=True)
+        delay_thread.start()
+
+        # Failed downloads are retried with exponential backoff, via the
+        # delay queue so that retries don't hold up new jobs
+        retry_policy = RetryPolicy(
+            CONFIG.get('retry_max_attempts', 5),
+            CONFIG.get('retry_base_delay', 5),
+            CONFIG.get('retry_max_delay', 600))
+
+        # Start workers to process the jobs from the queue
+        self.worker_threads = []
+
+        worker_args = {
+            'basepath': CONFIG['download_dir'],
+            'min_free_space': CONFIG['min_free_space'],
+            'stream': CONFIG.get('stream_downloads', False),
+            'chunk_size': CONFIG.get('download_chunk_size', 1048576),
+            'index': self.download_index,
+            'in_flight': in_flight,
+            'coalesce_timeout': CONFIG.get('download_coalesce_timeout', 60),
+            'source_stats': source_stats,
+            'breaker': breaker,
+            'delay_queue': delay_queue,
+            'retry_policy': retry_policy,
+            'connect_timeout': CONFIG.get('download_connect_timeout', 1.0),
+            'read_timeout': CONFIG.get('download_read_timeout', 60),
+            'deadline': CONFIG.get('download_deadline', 1800)
+        }
+
+        if CONFIG.get('download_engine', 'threads') == 'asyncio':
+            # A single worker running many downloads on an event loop,
+            # aiohttp is only needed for this engine
+            from wis2downloader.downloader.aio import AsyncDownloadWorker
+
+            def create_worker():
+                return AsyncDownloadWorker(
+                    self.queue,
+                    concurrency=CONFIG.get('download_concurrency', 100),
+                    batch_size=CONFIG.get('download_batch_size', 10),
+                    **worker_args)
+
+            self.workers = [create_worker()]
+        else:
+            def create_worker():
+                return DownloadWorker(self.queue, **worker_args)
+
+            self.workers = [create_worker()
+                            for idx in range(CONFIG['download_workers'])]
+
+        for worker in self.workers:
+            worker_thread = threading.Thread(target=worker.start,
+                                             daemon=True)
+            self.worker_threads.append(worker_thread)
+            worker_thread.start()
+
+        # Replace any workers stuck on a download
+        if CONFIG.get('worker_watchdog_timeout', 3600) > 0:
+            watchdog = WorkerWatchdog(
+                self.workers, self.worker_threads, create_worker,
+                CONFIG.get('worker_watchdog_timeout', 3600))
+            watchdog_thread = threading.Thread(target=watchdog.start,
+                                               daemon=True)
+            watchdog_thread.start()
+
+    def _start_subscriber(self) -> None:
+        CONFIG = self.config
+
+        # Now create the MQTT subscriber
+        self.mqtt_session = Path(
+            CONFIG.get('mqtt_session_info') or ".mqtt_session.json")
+        if self.mqtt_session.is_file():
+            with open(self.mqtt_session) as fh:
+                self.session_info = json.load(fh)
+                if self.session_info.get('client_id') is None:
+                    self.session_info['client_id'] = str(uuid4())
+        else:
+            self.session_info = {
+                'topics': {},
+                'client_id': str(uuid4())
+            }
+
+        LOGGER.info(self.session_info)
+
+        brokers = [{
+            'hostname': CONFIG['broker_hostname'],
+            'port': CONFIG['broker_port'],
+            'username': CONFIG['broker_username'],
+            'password': CONFIG['broker_password'],
+            'protocol': CONFIG['broker_protocol'],
+            'mqtt_version': CONFIG.get('broker_mqtt_version', 3)
+        }]
+        brokers.extend(CONFIG.get('additional_brokers', []))
+
+        self.subscriber = SubscriberManager(
+            brokers,
+            CONFIG.get('broker_connections', 1),
+            self.queue,
+            self.session_info['client_id'],
+            dedup_window=CONFIG.get('dedup_window'),
+            dedup_size=CONFIG.get('dedup_size', 100000),
+            backpressure_delay=CONFIG.get('queue_backpressure_delay', 0.01),
+            keep_payload=CONFIG.get('keep_payload', False),
+            decoder_threads=CONFIG.get('decoder_threads', 0),
+            decoder_queue_size=CONFIG.get('decoder_queue_size', 10000)
+        )
+
+        # Now spawn subscriber as thread, connecting to the brokers
+        self.mqtt_thread = threading.Thread(target=self.subscriber.start,
+                                            daemon=True)
+        self.mqtt_thread.start()
+
+    def _load_topic_hierarchy(self) -> None:
+        CONFIG = self.config
+
+        # Load the topic hierarchy once, refreshing it in the background
+        if CONFIG['validate_topics']:
+            TOPIC_VALIDATOR.ttl = CONFIG.get('topic_hierarchy_refresh_hours', 24) * 3600  # noqa
+            try:
+                TOPIC_VALIDATOR.load()
+            except Exception as e:
+                LOGGER.error(f"Unable to load the WIS2 topic hierarchy: {e}")  # noqa
+            topic_thread = threading.Thread(target=TOPIC_VALIDATOR.start,
+                                            daemon=True)
+            topic_thread.start()
+
+    def _restore_subscriptions(self) -> None:
+        # Add default subscriptions, with one SUBSCRIBE per connection
+        default_subscriptions = []
+        for topic, value in self.session_info['topics'].items():
+            item = {'topic': topic, 'target': value}
+            if isinstance(value, dict):
+                item = dict(value, topic=topic)
+
+            subscription, msg = self.check_subscription(item)
+            if subscription is None:
+                LOGGER.warning(
+                    f"Invalid subscription to {topic} in default config, please check config file ({msg})")  # noqa
+                continue
+            default_subscriptions.append(subscription)
+
+        self.subscriber.add_subscriptions(default_subscriptions)
+
+    def check_subscription(self, item: dict) -> tuple:
+        """
+        Validates a subscription, given as a dict with the topic, target
+        and, optionally, share_group and filters.
+
+        Returns:
+            tuple (dict, str): The subscription to add, with the defaults
+            applied, and an error message if it is invalid.
+        """
+        if not isinstance(item, dict) or not item.get('topic'):
+            return None, "No topic was provided. Please provide a valid topic"  # noqa
+
+        topic = unquote(item['topic'])
+        if self.config['validate_topics']:
+            is_topic_valid, msg = validate_topic(topic)
+            if not is_topic_valid:
+                return None, msg
+
+        target = item.get('target')
+        if target in (None, "$TOPIC"):
+            target = "$TOPIC"
+        is_target_valid, msg = validate_target(target)
+        if not is_target_valid:
+            return None, msg
+
+        # Shared subscription group validation
+        share_group = item.get('share_group')
+        if share_group is not None and (
+                not isinstance(share_group, str) or len(share_group) == 0 or
+                any(char in share_group for char in "/+#")):
+            return None, "share_group must be a non-empty string without /, + or #"  # noqa
+
+        filters = item.get('filters')
+        if filters:
+            try:
+                ContentFilter(filters)
+            except ValueError as e:
+                return None, str(e)
+
+        return {'topic': topic, 'target': target,
+                'share_group': share_group, 'filters': filters}, ""
+
+    @staticmethod
+    def session_entry(item: dict):
+        """Subscriptions are saved as the target, or a dict for shared or
+        filtered ones"""
+        if not (item.get('share_group') or item.get('filters')):
+            return item['target']
+        entry = {'target': item['target']}
+        if item.get('share_group'):
+            entry['share_group'] = item['share_group']
+        if item.get('filters'):
+            entry['filters'] = item['filters']
+        return entry
+
+    def save_session(self) -> None:
+        """Write the session info to a temporary file then move it in
+        place, so that the file is never left partly written"""
+        with self._session_lock:
+            with tempfile.NamedTemporaryFile(
+                    'w', dir=self.mqtt_session.parent,
+                    prefix=f".{self.mqtt_session.name}.", suffix=".tmp",
+                    delete=False) as fh:
+                json.dump(self.session_info, fh)
+            try:
+                os.replace(fh.name, self.mqtt_session)
+            except Exception:
+                Path(fh.name).unlink(missing_ok=True)
+                raise
+
+    def save_subscriptions(self, subscriptions: list) -> None:
+        """Add subscriptions, as returned by check_subscription, to the
+        session info and save it"""
+        with self._session_lock:
+            for item in subscriptions:
+                self.session_info['topics'][item['topic']] = \
+                    self.session_entry(item)
+            self.save_session()
+
+    def remove_subscription(self, topic: str) -> None:
+        """Remove a subscription from the session info and save it"""
+        with self._session_lock:
+            self.session_info['topics'].pop(topic, None)
+            self.save_session()
+
+    def shutdown(self) -> None:
+        """Stop the subscriber and workers, doing nothing if not started or
+        already stopped"""
+        with self._lock:
+            if not self.started or self.stopped:
+                return
+            self.stopped = True
+
+        LOGGER.info("Shutting down")
+
+        # Stop the subscriber first
+        self.subscriber.stop()
+
+        # Signal all other threads to stop
+        stop_event.set()
+
+        # now join mqtt thread
+        self.mqtt_thread.join()
+        LOGGER.info("Subscriber thread stopped")
+
+        for worker in self.worker_threads:
+            LOGGER.info("Shutting down worker threads")
+            # If download worker is blocked waiting for a job, send one
+            if self.queue.size() == 0:
+                self.queue.enqueue(Job(shutdown=True))
+            worker.join()
+
+        self.download_index.close()
+        if isinstance(self.queue, PersistentQueue):
+            self.queue.close()
+
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+
+def get_runtime() -> Runtime:
+    """The runtime of the process, created and started on first use and
+    shut down when the process exits, e.g. when a gunicorn worker exits"""
+    global _runtime
+    with _runtime_lock:
+        if _runtime is None:
+            _runtime = Runtime()
+            atexit.register(_runtime.shutdown)
+        _runtime.start()
+    return _runtime
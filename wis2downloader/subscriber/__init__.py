@@ -1,16 +1,31 @@
 from abc import ABC, abstractmethod
-from fnmatch import fnmatch
 import json
 from pathlib import Path
+import queue
 import ssl
+import threading
+import time
 from typing import Optional
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 from wis2downloader import stop_event
+from wis2downloader.job import Job
 from wis2downloader.log import LOGGER
 from wis2downloader.queue import BaseQueue
-from wis2downloader.metrics import TOPIC_STATUS
+from wis2downloader.subscriber.dedup import SeenMessages, message_key
+from wis2downloader.subscriber.filters import ContentFilter
+from wis2downloader.subscriber.topics import TopicMatcher
+from wis2downloader.metrics import (FILTERED_NOTIFICATIONS, STARTUP_SECONDS,
+                                    TOPIC_STATUS)
 
 
 class BaseSubscriber(ABC):
@@ -36,10 +51,17 @@ class BaseSubscriber(ABC):
         pass
 
     @abstractmethod
-    def add_subscription(self, topic: str, save_path: str):
+    def add_subscription(self, topic: str, save_path: str,
+                         share_group: Optional[str] = None,
+                         filters: Optional[dict] = None):
         """Method to add subscription to active subscriptions"""
         pass
 
+    @abstractmethod
+    def add_subscriptions(self, subscriptions: list):
+        """Method to add several subscriptions at once"""
+        pass
+
     @abstractmethod
     def delete_subscription(self, topic: str):
         """Method to remove subscription from active subscriptions"""
@@ -65,7 +87,12 @@ class MQTTSubscriber(BaseSubscriber):
     def __init__(self, broker: str = "globalbroker.meteo.fr", port: int = 443,
                  uid: str = "everyone", pwd: str = "everyone",
                  protocol: str = "websockets",
-                 _queue: Optional[BaseQueue] = None, client_id: str = ''):
+                 _queue: Optional[BaseQueue] = None, client_id: str = '',
+                 backpressure_delay: float = 0.01,
+                 keep_payload: bool = False, decoder_threads: int = 0,
+                 decoder_queue_size: int = 10000,
+                 dedup: Optional[SeenMessages] = None,
+                 mqtt_version: int = 3):
 
         LOGGER.warning("Initializing MQTT subscriber")
 
@@ -73,9 +100,14 @@ class MQTTSubscriber(BaseSubscriber):
             'callback_api_version': mqtt.CallbackAPIVersion.VERSION2,
             'transport': protocol,
         }
+        # MQTT 5 is needed for shared subscriptions
+        self.mqtt_version = mqtt_version
+        if mqtt_version == 5:
+            args['protocol'] = mqtt.MQTTv5
         if len(client_id) > 0:
             args['client_id'] = client_id
-            args['clean_session'] = False
+            if mqtt_version != 5:
+                args['clean_session'] = False
 
         LOGGER.info(args)
 
@@ -93,16 +125,59 @@ class MQTTSubscriber(BaseSubscriber):
         self.client.on_subscribe = self._on_subscribe
 
         self.queue = _queue
+        # Time the decoder threads pause for after each message while the
+        # queue is saturated. The network loop never pauses, it has to keep
+        # the connection alive
+        self.backpressure_delay = backpressure_delay
+        # Whether jobs keep the full notification, rather than only the
+        # parts needed for the download
+        self.keep_payload = keep_payload
         self.active_subscriptions = {}
-
-        # Connect to the broker
-        LOGGER.info("Connecting...")
+        # Snapshot of the subscriptions used to match incoming messages,
+        # replaced whenever the subscriptions change
+        self.matcher = TopicMatcher()
+        # Content filters of the subscriptions, compiled when added
+        self._filters = {}
+        self._lock = threading.Lock()
+        # With decoder threads the network loop only hands the raw messages
+        # over, they are decoded and queued by the decoder threads. At most
+        # decoder_queue_size messages are held for them
+        self.decoder_threads = decoder_threads
+        # Notifications already received, shared with other connections
+        self.dedup = dedup
+        self._messages = queue.Queue(decoder_queue_size)
+
+        # The connection is made by start(), in the thread running the
+        # network loop, so that several brokers are connected to at once
         LOGGER.info(f"Host: {broker}, port: {port}")
-        self.client.connect(host=broker, port=port)
+        connect_args = {'host': broker, 'port': port}
+        if mqtt_version == 5 and len(client_id) > 0:
+            # Keep the session, as clean_session=False does for MQTT 3
+            properties = Properties(PacketTypes.CONNECT)
+            properties.SessionExpiryInterval = 0xFFFFFFFF
+            connect_args['clean_start'] = False
+            connect_args['properties'] = properties
+        self.client.connect_async(**connect_args)
+        self._connect_started = None
 
     def _on_connect(self, client, userdata, flags, reason_code, properties):
         if reason_code == 0:
             LOGGER.info("Connected successfully")
+            if self._connect_started is not None:
+                # All connections start together, so the gauge ends up
+                # with the time taken by the slowest one
+                STARTUP_SECONDS.labels(phase='mqtt_connect').set(
+                    time.monotonic() - self._connect_started)
+                self._connect_started = None
+            # Subscriptions added before connecting, or lost with the
+            # session, are (re)made with a single SUBSCRIBE
+            with self._lock:
+                topic_filters = [
+                    (self.topic_filter(topic, subscription.get('share_group')), 1)  # noqa
+                    for topic, subscription in self.active_subscriptions.items()  # noqa
+                ]
+            if topic_filters:
+                client.subscribe(topic_filters)
         elif reason_code > 0:
             LOGGER.error(f"Connection failed with error code {reason_code}")
 
@@ -116,23 +191,46 @@ class MQTTSubscriber(BaseSubscriber):
         # first check shutdown is not set
         if stop_event.is_set():
             self.client.disconnect()
-        LOGGER.info(f"Message received under topic {msg.topic}")
-        target = self.active_subscriptions.get(msg.topic, {}).get('target')
-        # if a wild card is used in the subs target may not match
-        if target is None:
-            for key, value in self.active_subscriptions.items():
-                if fnmatch(msg.topic, value['pattern']):
-                    target = value['target']
-                    break
+
+        if self.decoder_threads > 0:
+            try:
+                self._messages.put_nowait((msg.topic, msg.payload))
+                return
+            except queue.Full:
+                # The decoders are slowed down by a saturated job queue.
+                # Rather than block, queue the job directly, a bounded job
+                # queue spills it to disk
+                pass
+
+        job, key = self.decode_message(msg.topic, msg.payload)
+        if job is not None:
+            job.queued_at = time.time()
+            try:
+                self.queue.enqueue(job)
+            except Exception:
+                self.release_seen([key])
+                raise
+
+    def decode_message(self, topic: str, payload: bytes) -> tuple:
+        """Create the job for a message, returning it with the key claimed
+        to detect duplicates of the message. The job is None if the message
+        should be skipped. If the job can't be queued the key should be
+        released with release_seen"""
+        LOGGER.info(f"Message received under topic {topic}")
+        match = self.matcher.match(topic)
+        target = None
+        if match is not None:
+            subscribed_topic, subscription, content_filter = match
+            target = subscription['target']
 
         if target is None:
             # subscription no longer active, return
             LOGGER.warning(
-                f"Topic {msg.topic} not found in active subscriptions, skipping")
-            return
+                f"Topic {topic} not found in active subscriptions, skipping")
+            return None, None
 
         if target == "$TOPIC":
-            target = msg.topic
+            target = topic
 
         if "/" in target:
             subdirs = target.split("/")
@@ -142,12 +240,69 @@ class MQTTSubscriber(BaseSubscriber):
             subdirs = target.split("\\")
             target = str(Path(*subdirs))
 
-        job = {
-            'topic': msg.topic,
-            'payload': json.loads(msg.payload),
-            'target': target
-        }
-        self.queue.enqueue(job)
+        notification = json_loads(payload)
+        if content_filter is not None and \
+                not content_filter.accepts(notification):
+            LOGGER.debug(f"Message under topic {topic} filtered out")
+            FILTERED_NOTIFICATIONS.labels(topic=subscribed_topic).inc()
+            return None, None
+
+        job = Job.from_notification(topic, notification, target,
+                                    keep_payload=self.keep_payload)
+
+        key = None
+        if self.dedup is not None:
+            key = message_key(notification)
+            # Claimed atomically, the same message may be received on
+            # several connections at once
+            if not self.dedup.add(key):
+                LOGGER.debug(f"Message {key} already received, skipping")
+                return None, None
+        return job, key
+
+    def release_seen(self, keys: list) -> None:
+        """Release the keys of messages whose jobs could not be queued"""
+        if self.dedup is not None:
+            for key in keys:
+                self.dedup.discard(key)
+
+    def run_decoder(self, batch_size: int = 100) -> None:
+        """Decode messages handed over by the network loop, queueing the
+        jobs in batches"""
+        while not stop_event.is_set():
+            try:
+                messages = [self._messages.get(timeout=1)]
+            except queue.Empty:
+                continue
+            while len(messages) < batch_size:
+                try:
+                    messages.append(self._messages.get_nowait())
+                except queue.Empty:
+                    break
+
+            jobs = []
+            keys = []
+            for topic, payload in messages:
+                try:
+                    job, key = self.decode_message(topic, payload)
+                except Exception as e:
+                    LOGGER.error(f"Failed to decode message under topic {topic}: {e}")  # noqa
+                    continue
+                if job is not None:
+                    jobs.append(job)
+                    keys.append(key)
+            if jobs:
+                queued_at = time.time()
+                for job in jobs:
+                    job.queued_at = queued_at
+                try:
+                    self.queue.enqueue_many(jobs)
+                except Exception as e:
+                    LOGGER.error(f"Failed to queue {len(jobs)} jobs: {e}")
+                    self.release_seen(keys)
+
+            if self.backpressure_delay > 0 and self.queue.is_saturated():
+                stop_event.wait(self.backpressure_delay * len(messages))
 
     def _on_subscribe(self, client, userdata, mid, reason_codes, properties):
         for sub_result in reason_codes:
@@ -157,21 +312,84 @@ class MQTTSubscriber(BaseSubscriber):
                 LOGGER.error(
                     f"Subscription to topic failed with error code {sub_result}")  # noqa
 
-    def add_subscription(self, topic: str, save_path: str = "."):
-        self.client.subscribe(topic, qos=1)
-        self.active_subscriptions[topic] = {
-            'target': save_path,
-            'pattern': topic.replace("+", "*").replace("#", "*")
-        }
-        LOGGER.info(f"Subscribing to {topic}")
-        # Set topic status to subscribed
-        TOPIC_STATUS.labels(topic=topic).set(1)
+    @staticmethod
+    def topic_filter(topic: str, share_group: Optional[str] = None) -> str:
+        """Filter to subscribe with, messages for a shared subscription are
+        spread over the subscribers in the same group"""
+        if share_group:
+            return f"$share/{share_group}/{topic}"
+        return topic
+
+    def _update_matcher(self) -> None:
+        """Replace the matcher, called with the lock held"""
+        self.matcher = TopicMatcher({
+            topic: (topic, subscription, self._filters.get(topic))
+            for topic, subscription in self.active_subscriptions.items()
+        })
+
+    def add_subscription(self, topic: str, save_path: str = ".",
+                         share_group: Optional[str] = None,
+                         filters: Optional[dict] = None):
+        return self.add_subscriptions([{
+            'topic': topic, 'target': save_path,
+            'share_group': share_group, 'filters': filters
+        }])
+
+    def add_subscriptions(self, subscriptions: list):
+        """Add several subscriptions, given as dicts with the topic, target
+        and, optionally, share_group and filters, with a single SUBSCRIBE.
+        Raises ValueError, subscribing to none, if any filters are
+        invalid."""
+        added = {}
+        content_filters = {}
+        for item in subscriptions:
+            topic = item['topic']
+            share_group = item.get('share_group')
+            filters = item.get('filters')
+            subscription = {'target': item.get('target', ".")}
+            if share_group:
+                if self.mqtt_version != 5:
+                    LOGGER.warning("Shared subscriptions require MQTT 5, set broker_mqtt_version to 5")  # noqa
+                subscription['share_group'] = share_group
+            if filters:
+                # Raises ValueError if the filters are invalid
+                content_filters[topic] = ContentFilter(filters)
+                subscription['filters'] = filters
+            added[topic] = subscription
+
+        if not added:
+            return self.active_subscriptions
+
+        # Subscriptions are recorded first so that they are made on
+        # connection if not yet connected
+        with self._lock:
+            for topic, subscription in added.items():
+                self.active_subscriptions[topic] = subscription
+                if topic in content_filters:
+                    self._filters[topic] = content_filters[topic]
+                else:
+                    self._filters.pop(topic, None)
+            self._update_matcher()
+        # Messages are published, and matched, under the topic itself
+        if self.client.is_connected():
+            self.client.subscribe([
+                (self.topic_filter(topic, subscription.get('share_group')), 1)  # noqa
+                for topic, subscription in added.items()
+            ])
+        for topic in added:
+            LOGGER.info(f"Subscribing to {topic}")
+            # Set topic status to subscribed
+            TOPIC_STATUS.labels(topic=topic).set(1)
         return self.active_subscriptions
 
     def delete_subscription(self, topic: str):
         if topic in self.active_subscriptions:
-            self.client.unsubscribe(topic)
-            del self.active_subscriptions[topic]
+            share_group = self.active_subscriptions[topic].get('share_group')
+            self.client.unsubscribe(self.topic_filter(topic, share_group))
+            with self._lock:
+                del self.active_subscriptions[topic]
+                self._filters.pop(topic, None)
+                self._update_matcher()
             LOGGER.info(f"Unsubscribing from {topic}")
             # Set topic status to unsubscribed
             TOPIC_STATUS.labels(topic=topic).set(0)
@@ -180,10 +398,15 @@ class MQTTSubscriber(BaseSubscriber):
         return self.active_subscriptions
 
     def list_subscriptions(self) -> dict:
-        return self.active_subscriptions
+        with self._lock:
+            return dict(self.active_subscriptions)
 
     def start(self):
-        self.client.loop_forever()
+        for _ in range(self.decoder_threads):
+            threading.Thread(target=self.run_decoder, daemon=True).start()
+        LOGGER.info("Connecting...")
+        self._connect_started = time.monotonic()
+        self.client.loop_forever(retry_first_connection=True)
 
     def stop(self):
         self.client.loop_stop()
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+import threading
+import time
+
+from wis2downloader.metrics import DEDUP_HITS, DEDUP_LOOKUPS
+
+
+def message_key(notification: dict):
+    """Key identifying a notification, its id or failing that the data_id
+    and publication time. None if neither is available"""
+    message_id = notification.get('id')
+    if message_id is not None:
+        return message_id
+    properties = notification.get('properties', {})
+    data_id = properties.get('data_id')
+    if data_id is None:
+        return None
+    return f"{data_id}@{properties.get('pubtime')}"
+
+
+class SeenMessages:
+    """
+    Record of the notifications received in the last `window` seconds,
+    holding at most `max_size` keys, used to skip duplicate notifications
+    (redelivered, replayed on reconnection or received on several
+    connections or subscriptions) before they are queued.
+    """
+    def __init__(self, max_size: int = 100000, window: float = 3600):
+        self.max_size = max_size
+        self.window = window
+        # Keys in the order first seen, with the time they were seen
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float) -> None:
+        # Forget keys older than the window, oldest first
+        while self._keys:
+            oldest, seen_at = next(iter(self._keys.items()))
+            if now - seen_at < self.window:
+                break
+            del self._keys[oldest]
+
+    def add(self, key) -> bool:
+        """Record key, returning False if it had already been seen. Messages
+        without a key are never treated as seen"""
+        if key is None:
+            return True
+        DEDUP_LOOKUPS.inc()
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key in self._keys:
+                DEDUP_HITS.inc()
+                return False
+            self._keys[key] = now
+            if len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+            return True
+
+    def discard(self, key) -> None:
+        """Forget key, e.g. as the job for the message could not be queued,
+        so that the message is accepted if received again"""
+        if key is None:
+            return
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def size(self) -> int:
+        return len(self._keys)
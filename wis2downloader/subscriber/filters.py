@@ -0,0 +1,128 @@
+import re
+
+FILTER_KEYS = ('media_types', 'max_length', 'data_id',
+               'wigos_station_identifiers', 'bbox')
+
+
+def _coordinates(coordinates):
+    """Flatten nested GeoJSON coordinates into (x, y) pairs"""
+    if not coordinates:
+        return
+    if isinstance(coordinates[0], (int, float)):
+        yield coordinates[0], coordinates[1]
+        return
+    for item in coordinates:
+        yield from _coordinates(item)
+
+
+class ContentFilter:
+    """
+    Filter on the content of notifications, compiled once when a
+    subscription is added from a dict with any of:
+
+    - media_types: list of accepted media types of the data
+    - max_length: largest size (bytes) of data to download
+    - data_id: regular expression searched for in the data_id
+    - wigos_station_identifiers: list of accepted WIGOS station ids
+    - bbox: [min lon, min lat, max lon, max lat] the geometry must
+      intersect. A min lon greater than the max lon crosses the antimeridian
+
+    A notification must pass all the given criteria. Raises ValueError if
+    the filters are invalid.
+    """
+    def __init__(self, filters: dict):
+        if not isinstance(filters, dict):
+            raise ValueError("filters must be an object")
+        unknown = set(filters) - set(FILTER_KEYS)
+        if unknown:
+            raise ValueError(f"unknown filters {sorted(unknown)}")
+
+        self.media_types = None
+        if filters.get('media_types') is not None:
+            media_types = filters['media_types']
+            if not isinstance(media_types, list):
+                raise ValueError("media_types must be a list")
+            self.media_types = frozenset(media_types)
+
+        self.max_length = filters.get('max_length')
+        if self.max_length is not None and (
+                not isinstance(self.max_length, int) or self.max_length < 0):
+            raise ValueError("max_length must be a positive integer")
+
+        self.data_id = None
+        if filters.get('data_id') is not None:
+            try:
+                self.data_id = re.compile(filters['data_id'])
+            except (re.error, TypeError) as e:
+                raise ValueError(f"invalid data_id pattern ({e})")
+
+        self.stations = None
+        if filters.get('wigos_station_identifiers') is not None:
+            stations = filters['wigos_station_identifiers']
+            if not isinstance(stations, list):
+                raise ValueError("wigos_station_identifiers must be a list")
+            self.stations = frozenset(stations)
+
+        self.bbox = None
+        if filters.get('bbox') is not None:
+            bbox = filters['bbox']
+            if not isinstance(bbox, list) or len(bbox) != 4 or \
+                    not all(isinstance(v, (int, float)) for v in bbox):
+                raise ValueError("bbox must be [min lon, min lat, max lon, max lat]")  # noqa
+            if bbox[1] > bbox[3]:
+                raise ValueError("bbox min lat must not exceed max lat")
+            self.bbox = tuple(bbox)
+
+    def _intersects(self, geometry) -> bool:
+        if not geometry:
+            return False
+        points = list(_coordinates(geometry.get('coordinates')))
+        if not points:
+            return False
+        min_x, min_y, max_x, max_y = self.bbox
+        xs = [x for x, _ in points]
+        ys = [y for _, y in points]
+        if max(ys) < min_y or min(ys) > max_y:
+            return False
+        if min_x <= max_x:
+            return max(xs) >= min_x and min(xs) <= max_x
+        # The box crosses the antimeridian
+        return max(xs) >= min_x or min(xs) <= max_x
+
+    def accepts(self, notification: dict) -> bool:
+        properties = notification.get('properties', {})
+
+        if self.media_types is not None or self.max_length is not None:
+            # As for the download, update links take precedence
+            links = notification.get('links', [])
+            chosen = [link for link in links if link.get('rel') == 'update']
+            if not chosen:
+                chosen = [link for link in links
+                          if link.get('rel') == 'canonical']
+            link = chosen[0] if chosen else {}
+            if self.media_types is not None and \
+                    link.get('type') not in self.media_types:
+                return False
+            length = link.get('length')
+            if self.max_length is not None and length is not None:
+                # Some publishers give the length as a string
+                try:
+                    length = int(length)
+                except (TypeError, ValueError):
+                    return False
+                if length > self.max_length:
+                    return False
+
+        if self.data_id is not None and \
+                not self.data_id.search(properties.get('data_id') or ''):
+            return False
+
+        if self.stations is not None and \
+                properties.get('wigos_station_identifier') not in self.stations:  # noqa
+            return False
+
+        if self.bbox is not None and \
+                not self._intersects(notification.get('geometry')):
+            return False
+
+        return True
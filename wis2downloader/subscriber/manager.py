@@ -0,0 +1,133 @@
+import threading
+from typing import Optional
+import zlib
+
+from wis2downloader.log import LOGGER
+from wis2downloader.queue import BaseQueue
+from wis2downloader.subscriber import MQTTSubscriber
+from wis2downloader.subscriber.dedup import SeenMessages
+from wis2downloader.subscriber.filters import ContentFilter
+
+
+class SubscriberManager:
+    """
+    Spreads subscriptions over `connections` MQTT connections to each of
+    `brokers`, given as dicts with the hostname, port, username, password,
+    protocol and, optionally, mqtt_version of each broker.
+
+    Each topic is subscribed to on one connection to every broker, chosen
+    by hashing the topic. Notifications received more than once within
+    `dedup_window` seconds, whether redelivered or received from several
+    brokers or overlapping subscriptions, are dropped before being queued.
+    At most `dedup_size` notifications are remembered. By default the
+    window is an hour with more than one connection, otherwise the check is
+    off; a window of 0 disables it. Other arguments are passed to
+    MQTTSubscriber, or to `subscriber_class` if overridden.
+    """
+    subscriber_class = MQTTSubscriber
+
+    def __init__(self, brokers: list, connections: int = 1,
+                 _queue: Optional[BaseQueue] = None, client_id: str = '',
+                 dedup_window: Optional[float] = None,
+                 dedup_size: int = 100000, **kwargs):
+        if not brokers:
+            raise ValueError("At least one broker is required")
+        if connections < 1:
+            raise ValueError("connections must be at least 1")
+        self.brokers = brokers
+        self.connections = connections
+        total = len(brokers) * connections
+        if dedup_window is None:
+            # Connections receive the same notifications
+            dedup_window = 3600 if total > 1 else 0
+        self.seen = None
+        if dedup_window > 0:
+            self.seen = SeenMessages(dedup_size, dedup_window)
+
+        # Connections by broker
+        self.subscribers = []
+        for broker_idx, broker in enumerate(brokers):
+            subscribers = []
+            for idx in range(connections):
+                # Persistent sessions need a client id per connection
+                _client_id = client_id
+                if client_id and total > 1:
+                    _client_id = f"{client_id}-{broker_idx * connections + idx}"  # noqa
+                subscribers.append(self.subscriber_class(
+                    broker['hostname'], broker['port'], broker['username'],
+                    broker['password'], broker['protocol'], _queue,
+                    _client_id, dedup=self.seen,
+                    mqtt_version=broker.get('mqtt_version', 3), **kwargs))
+            self.subscribers.append(subscribers)
+
+        self.active_subscriptions = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def shard(self, topic: str) -> int:
+        """Index of the connection to each broker used for topic"""
+        return zlib.crc32(topic.encode('utf-8')) % self.connections
+
+    def subscribers_for(self, topic: str) -> list:
+        idx = self.shard(topic)
+        return [subscribers[idx] for subscribers in self.subscribers]
+
+    def add_subscription(self, topic: str, save_path: str = ".",
+                         share_group: Optional[str] = None,
+                         filters: Optional[dict] = None):
+        if filters:
+            # Check the filters before subscribing anywhere
+            ContentFilter(filters)
+        for subscriber in self.subscribers_for(topic):
+            subscription = subscriber.add_subscription(
+                topic, save_path, share_group, filters)[topic]
+        with self._lock:
+            self.active_subscriptions[topic] = subscription
+        return self.active_subscriptions
+
+    def add_subscriptions(self, subscriptions: list):
+        """Add several subscriptions, given as dicts with the topic, target
+        and, optionally, share_group and filters, with one SUBSCRIBE per
+        connection"""
+        for item in subscriptions:
+            if item.get('filters'):
+                # Check the filters before subscribing anywhere
+                ContentFilter(item['filters'])
+        shards = {}
+        for item in subscriptions:
+            shards.setdefault(self.shard(item['topic']), []).append(item)
+        for idx, items in shards.items():
+            for subscribers in self.subscribers:
+                active = subscribers[idx].add_subscriptions(items)
+            with self._lock:
+                for item in items:
+                    self.active_subscriptions[item['topic']] = \
+                        active[item['topic']]
+        return self.active_subscriptions
+
+    def delete_subscription(self, topic: str):
+        for subscriber in self.subscribers_for(topic):
+            subscriber.delete_subscription(topic)
+        with self._lock:
+            self.active_subscriptions.pop(topic, None)
+        return self.active_subscriptions
+
+    def list_subscriptions(self) -> dict:
+        with self._lock:
+            return dict(self.active_subscriptions)
+
+    def start(self):
+        LOGGER.info(f"Starting {len(self.brokers) * self.connections} MQTT connections")  # noqa
+        for subscribers in self.subscribers:
+            for subscriber in subscribers:
+                thread = threading.Thread(target=subscriber.start,
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        for thread in self._threads:
+            thread.join()
+
+    def stop(self):
+        for subscribers in self.subscribers:
+            for subscriber in subscribers:
+                subscriber.stop()
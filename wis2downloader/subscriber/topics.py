@@ -0,0 +1,53 @@
+_VALUE = None  # key of the value stored at a node, never a topic level
+
+
+class TopicMatcher:
+    """
+    Immutable trie of MQTT topic filters, matching topics in time
+    proportional to their depth with MQTT semantics: `+` matches a single
+    level and `#` any number of levels, including none, below its parent.
+    Wildcards do not match topics starting with `$`.
+
+    Build a new matcher when the filters change. Where several filters
+    match a topic an exact match is preferred, then the filter added first.
+    """
+    def __init__(self, filters: dict = None):
+        self._exact = {}
+        self._root = {}
+        for order, (topic_filter, value) in enumerate((filters or {}).items()):  # noqa
+            self._exact[topic_filter] = value
+            node = self._root
+            for level in topic_filter.split('/'):
+                node = node.setdefault(level, {})
+            node[_VALUE] = (order, value)
+
+    def __len__(self):
+        return len(self._exact)
+
+    def match(self, topic: str):
+        """Return the value of the best filter matching topic, or None"""
+        value = self._exact.get(topic)
+        if value is not None:
+            return value
+
+        levels = topic.split('/')
+        depth = len(levels)
+        best = None
+        stack = [(self._root, 0)]
+        while stack:
+            node, idx = stack.pop()
+            wildcards = idx > 0 or not levels[0].startswith('$')
+            if wildcards and '#' in node and _VALUE in node['#']:
+                if best is None or node['#'][_VALUE][0] < best[0]:
+                    best = node['#'][_VALUE]
+            if idx == depth:
+                if _VALUE in node and (best is None or node[_VALUE][0] < best[0]):  # noqa
+                    best = node[_VALUE]
+                continue
+            child = node.get(levels[idx])
+            if child is not None:
+                stack.append((child, idx + 1))
+            if wildcards and '+' in node:
+                stack.append((node['+'], idx + 1))
+
+        return None if best is None else best[1]
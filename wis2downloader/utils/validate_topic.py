@@ -1,9 +1,127 @@
+from functools import lru_cache
+from pathlib import Path
+import shutil
+import tempfile
+import threading
+import time
+
 from pywis_topics.topics import TopicHierarchy
-from pywis_topics.bundle import sync_bundle
+from pywis_topics.bundle import USERDIR, sync_bundle
 
+from wis2downloader import stop_event
 from wis2downloader.log import LOGGER
 
 
+class TopicValidator:
+    """
+    Validates topics against the WIS2 topic hierarchy, loaded once from the
+    local pywis-topics bundle (synced only if missing) and refreshed every
+    `ttl` seconds by start(). The results for the most recent `cache_size`
+    topics are cached.
+
+    If a refresh fails, e.g. while offline, the hierarchy already loaded
+    and the local bundle are kept. If no hierarchy could be loaded at all,
+    the failure is raised again without retrying for `retry_interval`
+    seconds, or until a refresh succeeds.
+    """
+    def __init__(self, ttl: float = 86400, cache_size: int = 4096,
+                 tables: str = None, retry_interval: float = 300):
+        self.ttl = ttl
+        self.cache_size = cache_size
+        # Directory holding the bundle, the pywis-topics default if None
+        self.tables = tables
+        self.retry_interval = retry_interval
+        self._validate = None
+        # The last failure to load the hierarchy and when it happened
+        self._error = None
+        self._failed_at = None
+        self._lock = threading.Lock()
+
+    def _use(self, hierarchy: TopicHierarchy) -> None:
+        def validate(topic):
+            try:
+                # strict=False allows for wildcards
+                return hierarchy.validate(topic, strict=False)
+            except ValueError:
+                return False
+
+        self._validate = lru_cache(maxsize=self.cache_size)(validate)
+
+    def load(self) -> None:
+        """Load the hierarchy from the local bundle, syncing it first if
+        there is none"""
+        with self._lock:
+            if self._validate is not None:
+                # Loaded, or refreshed, while waiting for the lock
+                return
+            if self._failed_at is not None and \
+                    time.monotonic() - self._failed_at < self.retry_interval:
+                raise self._error
+            try:
+                try:
+                    hierarchy = TopicHierarchy(self.tables)
+                except OSError:
+                    LOGGER.info("No local topic hierarchy bundle, syncing")
+                    if not self.sync():
+                        raise
+                    hierarchy = TopicHierarchy(self.tables)
+            except Exception as e:
+                self._error = e
+                self._failed_at = time.monotonic()
+                raise
+            self._error = self._failed_at = None
+            self._use(hierarchy)
+
+    def sync(self) -> bool:
+        """Sync the bundle, restoring the previous one on failure"""
+        if self.tables is not None:
+            return False
+
+        backup = None
+        if USERDIR.exists():
+            backup = Path(tempfile.mkdtemp()) / 'bundle'
+            shutil.copytree(USERDIR, backup)
+        try:
+            sync_bundle()
+            return True
+        except Exception as e:
+            LOGGER.error(f"Unable to sync topic hierarchy bundle: {e}")
+            if backup is not None:
+                shutil.rmtree(USERDIR, ignore_errors=True)
+                shutil.copytree(backup, USERDIR)
+            return False
+        finally:
+            if backup is not None:
+                shutil.rmtree(backup.parent, ignore_errors=True)
+
+    def refresh(self) -> bool:
+        if not self.sync():
+            return False
+        try:
+            hierarchy = TopicHierarchy(self.tables)
+        except Exception as e:
+            LOGGER.error(f"Unable to load topic hierarchy: {e}")
+            return False
+        with self._lock:
+            self._error = self._failed_at = None
+            self._use(hierarchy)
+        LOGGER.info("Topic hierarchy refreshed")
+        return True
+
+    def is_valid(self, topic: str) -> bool:
+        if self._validate is None:
+            self.load()
+        return self._validate(topic)
+
+    def start(self) -> None:
+        """Refresh the hierarchy every ttl seconds until stopped"""
+        while not stop_event.wait(self.ttl):
+            self.refresh()
+
+
+TOPIC_VALIDATOR = TopicValidator()
+
+
 def validate_topic(topic) -> tuple:
     """
     Validates the topic using pywis-topics.
@@ -20,10 +138,12 @@ def validate_topic(topic) -> tuple:
         LOGGER.error(no_topic_error)
         return False, no_topic_error
 
-    # Use pywis-topics to validate the topic: strict=False allows for wildcards
-    sync_bundle()
-    th = TopicHierarchy()
-    is_valid = th.validate(topic, strict=False)
+    try:
+        is_valid = TOPIC_VALIDATOR.is_valid(topic)
+    except Exception as e:
+        unavailable_error = f"Unable to validate topic ({topic}), the WIS2 topic hierarchy is unavailable: {e}"  # noqa
+        LOGGER.error(unavailable_error)
+        return False, unavailable_error
 
     bad_topic_error = f"Invalid topic ({topic}), topic must validate against the WIS2 topic hierarchy."  # noqa
 